@@ -20,6 +20,7 @@ class InferenceConfig(PrintableConfig):
 
     checkpoint_S: str = make_abs_path('../../pretrained_weights/liveportrait/retargeting_models/stitching_retargeting_module.pth')  # path to checkpoint
     flag_use_half_precision: bool = True  # whether to use half precision
+    half_precision_dtype: Literal['auto', 'bfloat16'] = 'auto'  # auto: float16 on cuda and float32 on cpu; bfloat16: on cuda and on cpus with native bf16
 
     flag_lip_zero: bool = True  # whether let the lip to close state before animation, only take effect when flag_eye_retargeting and flag_lip_retargeting is False
     lip_zero_threshold: float = 0.03
@@ -38,6 +39,8 @@ class InferenceConfig(PrintableConfig):
 
     flag_write_result: bool = True  # whether to write output video
     flag_pasteback: bool = True  # whether to paste-back/stitch the animated face cropping from the face-cropping space to the original image space
+    pasteback_backend: Literal['auto', 'torch', 'roi', 'cv2'] = 'auto'  # torch: grid_sample and blend on the device of G; roi: cv2.remap and fixed-point blend of the mask ROI on the host; cv2: full-frame warpAffine and float blend on the host; auto: torch, or roi when G runs on cpu
+    output_mode: Literal['both', 'crops', 'full'] = 'both'  # which outputs to produce, the work of the other one is skipped; full needs flag_pasteback
     mask_crop = None
     flag_write_gif: bool = False
     size_gif: int = 256
@@ -47,3 +50,7 @@ class InferenceConfig(PrintableConfig):
     device_id: int = 0
     flag_do_crop: bool = False  # whether to crop the reference portrait to the face-cropping space
     flag_do_rot: bool = True  # whether to conduct the rotation when flag_do_crop is True
+    source_batch_size: int = 4  # number of source images animated together through W and G
+    batch_size: int = 1  # number of driving frames animated per step through M, stitching and W+G
+    pipeline_queue_depth: int = 2  # chunks in flight between two stages of the animation pipeline, 0 runs the stages sequentially
+    num_threads: int = 0  # torch intra-op threads while running on cpu (LivePortraitWrapper.cpu_threads), 0 keeps the torch default
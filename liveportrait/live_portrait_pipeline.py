@@ -4,22 +4,28 @@
 Pipeline of LivePortrait
 """
 
+import hashlib
 import cv2
 import numpy as np
+import torch
 import os.path as osp
 from rich.progress import track
 
 from .config.inference_config import InferenceConfig
 
 #from .utils.cropper import Cropper
-from .utils.camera import get_rotation_matrix
+from .utils.camera import get_rotation_matrix, compose_driving_keypoints
 #from .utils.video import images2video, concat_frames
 from .utils.crop import _transform_img
+from .utils.paste_back import TorchPasteBack, RoiPasteBack, mask_roi
+from .utils.executor import PipelinedExecutor
+from .utils.motion_cache import hash_frames, module_fingerprint
+from .utils.motion_track import MotionTrack
 #from .utils.retargeting_utils import calc_lip_close_ratio
 #from .utils.io import load_image_rgb, load_driving_info
 #from .utils.helper import mkdir, basename, dct2cuda, is_video, is_template, resize_to_limit
 from .utils.helper import resize_to_limit
-#from .utils.rprint import rlog as log
+from .utils.rprint import rlog as log
 from .live_portrait_wrapper import LivePortraitWrapper
 
 import comfy.utils
@@ -36,16 +42,26 @@ class LivePortraitPipeline(object):
         self.live_portrait_wrapper: LivePortraitWrapper = LivePortraitWrapper(
                 appearance_feature_extractor, motion_extractor, warping_module,
                 spade_generator, stitching_retargeting_module, cfg=inference_cfg)
+        self.motion_cache = None  # a utils.motion_cache.MotionCache, to reuse the motion of driving clips seen before
+        self._motion_fingerprint = None
 
-    def execute(self, img_rgb, driving_images_np):
+    def prepare_source(self, img_rgb, crop_cfg=None, with_paste_back=None) -> dict:
+        """ crop the reference portrait and run the source-dependent stages (F and M) once
+        with_paste_back: whether to prepare the paste-back, None to follow get_outputs
+        """
         inference_cfg = self.live_portrait_wrapper.cfg # for convenience
         ######## process reference portrait ########
         #img_rgb = load_image_rgb(args.source_image)
         img_rgb = resize_to_limit(img_rgb, inference_cfg.ref_max_shape, inference_cfg.ref_shape_n)
         #log(f"Load source image from {args.source_image}")
-        crop_info = self.cropper.crop_single_image(img_rgb)
+        crop_kwargs = {} if crop_cfg is None else dict(
+            dsize=crop_cfg.dsize, scale=crop_cfg.scale, vx_ratio=crop_cfg.vx_ratio, vy_ratio=crop_cfg.vy_ratio)
+        crop_info = self.cropper.crop_single_image(img_rgb, **crop_kwargs)
         source_lmk = crop_info['lmk_crop']
         img_crop, img_crop_256x256 = crop_info['img_crop'], crop_info['img_crop_256x256']
+        # G and the mask template render 512x512 crops, map them back through the dsize crop
+        crop_scale = img_crop.shape[0] / 512
+        M_c2o = crop_info['M_c2o'] @ np.diag([crop_scale, crop_scale, 1.]).astype(np.float32)
         if inference_cfg.flag_do_crop:
             I_s = self.live_portrait_wrapper.prepare_source(img_crop_256x256)
         else:
@@ -56,132 +72,432 @@ class LivePortraitPipeline(object):
         f_s = self.live_portrait_wrapper.extract_feature_3d(I_s)
         x_s = self.live_portrait_wrapper.transform_keypoint(x_s_info)
 
+        lip_delta_before_animation = None
         if inference_cfg.flag_lip_zero:
             # let lip-open scalar to be 0 at first
             c_d_lip_before_animation = [0.]
             combined_lip_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_before_animation, source_lmk)
-            if combined_lip_ratio_tensor_before_animation[0][0] < inference_cfg.lip_zero_threshold:
-                inference_cfg.flag_lip_zero = False
-            else:
+            if combined_lip_ratio_tensor_before_animation[0][0] >= inference_cfg.lip_zero_threshold:
                 lip_delta_before_animation = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor_before_animation)
         ############################################
 
+        ######## prepare for pasteback ########
+        mask_ori, paste_back, paste_roi = None, None, None
+        if with_paste_back is None:
+            with_paste_back = self.get_outputs()[1]
+        if with_paste_back:
+            if inference_cfg.mask_crop is None:
+                inference_cfg.mask_crop = cv2.imread(make_abs_path('./utils/resources/mask_template.png'), cv2.IMREAD_COLOR)
+            pasteback_backend = self.get_pasteback_backend()
+            if pasteback_backend == 'torch':
+                paste_back = TorchPasteBack(img_rgb, M_c2o, inference_cfg.mask_crop, self.live_portrait_wrapper.device)
+            elif pasteback_backend == 'roi':
+                paste_back = RoiPasteBack(img_rgb, M_c2o, inference_cfg.mask_crop)
+            else:
+                mask_ori = _transform_img(inference_cfg.mask_crop, M_c2o, dsize=(img_rgb.shape[1], img_rgb.shape[0]))
+                mask_ori = mask_ori.astype(np.float32) / 255.
+            paste_roi = paste_back.roi if paste_back is not None else mask_roi(mask_ori[..., 0] > 0)
+        #########################################
+
+        return {
+            'img_rgb': img_rgb,
+            'crop_info': crop_info,
+            'M_c2o': M_c2o,
+            'mask_ori': mask_ori,  # cv2 paste-back only
+            'paste_back': paste_back,  # TorchPasteBack or RoiPasteBack, None for the cv2 paste-back
+            'paste_roi': paste_roi,  # (slice y, slice x), the region of img_rgb the paste-back changes, None if it is empty
+            'source_lmk': source_lmk,
+            'x_s_info': x_s_info,
+            'x_c_s': x_c_s,
+            'R_s': R_s,
+            'f_s': f_s,
+            'x_s': x_s,
+            'lip_delta_before_animation': lip_delta_before_animation,
+        }
+
+    @staticmethod
+    def source_to(source, device) -> dict:
+        """ a copy of a prepare_source dict with its tensors on device, to keep an encoded source off the gpu between runs
+        """
+        def _to(v):
+            return None if v is None else v.to(device)
+
+        moved = dict(source)
+        moved['x_s_info'] = {k: _to(v) for k, v in source['x_s_info'].items()}
+        for key in ('x_c_s', 'R_s', 'f_s', 'x_s', 'lip_delta_before_animation'):
+            moved[key] = _to(source[key])
+        if isinstance(source['paste_back'], TorchPasteBack):
+            moved['paste_back'] = source['paste_back'].to(device)
+        return moved
+
+    def prepare_driving_chunk(self, driving_rgb_chunk) -> dict:
+        """ run the driving-dependent stages (M, retargeting ratios) on a chunk of driving frames
+        driving_rgb_chunk: TxHxWx3, uint8 array, or float 0~1 tensor (ComfyUI IMAGE) resized on the device
+        """
+        inference_cfg = self.live_portrait_wrapper.cfg # for convenience
         ######## process driving info ########
         #if is_video(args.driving_info):
         #log(f"Load from video file (mp4 mov avi etc...): {args.driving_info}")
         # TODO: 这里track一下驱动视频 -> 构建模板
         #driving_rgb_lst = load_driving_info(args.driving_info)
 
-        driving_rgb_lst = driving_images_np
+        driving_rgb_lst = driving_rgb_chunk
 
-        driving_rgb_lst_256 = [cv2.resize(_, (256, 256)) for _ in driving_rgb_lst]
-        I_d_lst = self.live_portrait_wrapper.prepare_driving_videos(driving_rgb_lst_256)
-        n_frames = I_d_lst.shape[0]
+        # only this chunk is resized and uploaded, so the memory does not grow with the clip length
+        if isinstance(driving_rgb_lst, torch.Tensor):
+            I_d = self.live_portrait_wrapper.prepare_driving_images(driving_rgb_lst)  # Tx3x256x256
+        else:
+            driving_rgb_256 = np.empty((len(driving_rgb_lst), 256, 256, 3), dtype=np.uint8)
+            for i, driving_rgb in enumerate(driving_rgb_lst):
+                cv2.resize(driving_rgb, (256, 256), dst=driving_rgb_256[i])
+            I_d = self.live_portrait_wrapper.prepare_driving_videos(driving_rgb_256[..., np.newaxis]).flatten(0, 1)  # Tx3x256x256
+
+        x_d_info = self.live_portrait_wrapper.get_kp_info(I_d)
+        R_d = get_rotation_matrix(x_d_info['pitch'], x_d_info['yaw'], x_d_info['roll'])
+
+        input_eye_ratio, input_lip_ratio = None, None
         if inference_cfg.flag_eye_retargeting or inference_cfg.flag_lip_retargeting:
+            if isinstance(driving_rgb_lst, torch.Tensor):
+                driving_rgb_lst = (driving_rgb_lst * 255).byte().numpy()  # the landmark runner works on uint8 frames
             driving_lmk_lst = self.cropper.get_retargeting_lmk_info(driving_rgb_lst)
-            input_eye_ratio_lst, input_lip_ratio_lst = self.live_portrait_wrapper.calc_retargeting_ratio(source_lmk, driving_lmk_lst)
-
-        # elif is_template(args.driving_info):
-        #     log(f"Load from video templates {args.driving_info}")
-        #     with open(args.driving_info, 'rb') as f:
-        #         template_lst, driving_lmk_lst = pickle.load(f)
-        #     n_frames = template_lst[0]['n_frames']
-        #     input_eye_ratio_lst, input_lip_ratio_lst = self.live_portrait_wrapper.calc_retargeting_ratio(source_lmk, driving_lmk_lst)
-        # else:
-        #     raise Exception("Unsupported driving types!")
-        #########################################
+            input_eye_ratio_lst, input_lip_ratio_lst = self.live_portrait_wrapper.calc_retargeting_ratio(None, driving_lmk_lst)
+            input_eye_ratio = np.concatenate(input_eye_ratio_lst, axis=0)[:, :1]  # Tx1, the left eye ratio drives both eyes
+            input_lip_ratio = np.concatenate(input_lip_ratio_lst, axis=0)  # Tx1
 
-        ######## prepare for pasteback ########
-        if inference_cfg.flag_pasteback:
-            if inference_cfg.mask_crop is None:
-                inference_cfg.mask_crop = cv2.imread(make_abs_path('./utils/resources/mask_template.png'), cv2.IMREAD_COLOR)
-            mask_ori = _transform_img(inference_cfg.mask_crop, crop_info['M_c2o'], dsize=(img_rgb.shape[1], img_rgb.shape[0]))
-            mask_ori = mask_ori.astype(np.float32) / 255.
-            I_p_paste_lst = []
+        # a template (see utils.motion_track.MotionTrack) skips this function, iter_driving_chunks reads it directly
         #########################################
 
-        I_p_lst = []
-        R_d_0, x_d_0_info = None, None
-        pbar = comfy.utils.ProgressBar(n_frames)
-        for i in track(range(n_frames), description='Animating...', total=n_frames):
-            #if is_video(args.driving_info):
-            # extract kp info by M
-            I_d_i = I_d_lst[i]
-            x_d_i_info = self.live_portrait_wrapper.get_kp_info(I_d_i)
-            R_d_i = get_rotation_matrix(x_d_i_info['pitch'], x_d_i_info['yaw'], x_d_i_info['roll'])
-            # else:
-            #     # from template
-            #     x_d_i_info = template_lst[i]
-            #     x_d_i_info = dct2cuda(x_d_i_info, inference_cfg.device_id)
-            #     R_d_i = x_d_i_info['R_d']
-
-            if i == 0:
-                R_d_0 = R_d_i
-                x_d_0_info = x_d_i_info
-
-            if inference_cfg.flag_relative:
-                R_new = (R_d_i @ R_d_0.permute(0, 2, 1)) @ R_s
-                delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
-                scale_new = x_s_info['scale'] * (x_d_i_info['scale'] / x_d_0_info['scale'])
-                t_new = x_s_info['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
-            else:
-                R_new = R_d_i
-                delta_new = x_d_i_info['exp']
-                scale_new = x_s_info['scale']
-                t_new = x_d_i_info['t']
-
-            t_new[..., 2].fill_(0) # zero tz
-            x_d_i_new = scale_new * (x_c_s @ R_new + delta_new) + t_new
-
-            # Algorithm 1:
-            if not inference_cfg.flag_stitching and not inference_cfg.flag_eye_retargeting and not inference_cfg.flag_lip_retargeting:
-                # without stitching or retargeting
-                if inference_cfg.flag_lip_zero:
-                    x_d_i_new += lip_delta_before_animation.reshape(-1, x_s.shape[1], 3)
-                else:
-                    pass
-            elif inference_cfg.flag_stitching and not inference_cfg.flag_eye_retargeting and not inference_cfg.flag_lip_retargeting:
-                # with stitching and without retargeting
-                if inference_cfg.flag_lip_zero:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new) + lip_delta_before_animation.reshape(-1, x_s.shape[1], 3)
-                else:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
+        return {
+            'n_frames': len(driving_rgb_lst),
+            'x_d_info': x_d_info,  # stacked over the frames, Tx...
+            'R_d': R_d,  # Tx3x3
+            'input_eye_ratio': input_eye_ratio,  # Tx1 or None
+            'input_lip_ratio': input_lip_ratio,  # Tx1 or None
+        }
+
+    def iter_driving_chunks(self, driving_images_np):
+        """ the driving frames in chunks of batch_size frames, one list of frames per chunk
+        driving_images_np: an array or a tensor of frames, a lazy source of chunks such as utils.video.DrivingVideo,
+        or a utils.motion_track.MotionTrack
+        """
+        batch_size = self.get_batch_size()
+        if isinstance(driving_images_np, MotionTrack):
+            # the motion is already extracted, the chunks are motion dicts and skip M
+            yield from driving_images_np.iter_driving(batch_size, self.live_portrait_wrapper.device)
+            return
+        if hasattr(driving_images_np, 'iter_chunks'):
+            yield from driving_images_np.iter_chunks(batch_size)
+            return
+        for i in range(0, len(driving_images_np), batch_size):
+            yield driving_images_np[i:i + batch_size]
+
+    @staticmethod
+    def concat_driving(chunks) -> dict:
+        """ merge the prepare_driving_chunk dicts of consecutive chunks
+        """
+        def _cat_ratio(key):
+            return None if chunks[0][key] is None else np.concatenate([_[key] for _ in chunks], axis=0)
+
+        return {
+            'n_frames': sum(_['n_frames'] for _ in chunks),
+            'x_d_info': {k: torch.cat([_['x_d_info'][k] for _ in chunks], dim=0) for k in chunks[0]['x_d_info'].keys()},
+            'R_d': torch.cat([_['R_d'] for _ in chunks], dim=0),
+            'input_eye_ratio': _cat_ratio('input_eye_ratio'),
+            'input_lip_ratio': _cat_ratio('input_lip_ratio'),
+        }
+
+    @staticmethod
+    def split_driving(driving, batch_size) -> list:
+        """ the inverse of concat_driving, chunks of batch_size frames
+        """
+        def _slice(v, i):
+            return None if v is None else v[i:i + batch_size]
+
+        return [{
+            'n_frames': min(batch_size, driving['n_frames'] - i),
+            'x_d_info': {k: v[i:i + batch_size] for k, v in driving['x_d_info'].items()},
+            'R_d': driving['R_d'][i:i + batch_size],
+            'input_eye_ratio': _slice(driving['input_eye_ratio'], i),
+            'input_lip_ratio': _slice(driving['input_lip_ratio'], i),
+        } for i in range(0, driving['n_frames'], batch_size)]
+
+    def motion_cache_key(self, driving_images_np) -> str:
+        """ the key of the motion of these driving frames: their content, the weights of M and the options that change
+        the motion dict (precision, whether the retargeting ratios are computed), and with the ratios the landmark models
+        """
+        inference_cfg = self.live_portrait_wrapper.cfg # for convenience
+        if self._motion_fingerprint is None:
+            self._motion_fingerprint = module_fingerprint(self.live_portrait_wrapper.motion_extractor)
+        with_ratios = inference_cfg.flag_eye_retargeting or inference_cfg.flag_lip_retargeting
+        options = f'{self._motion_fingerprint}:{inference_cfg.flag_use_half_precision}:{getattr(inference_cfg, "half_precision_dtype", "auto")}:' \
+                  f'{tuple(inference_cfg.input_shape)}:{with_ratios}'
+        if with_ratios:
+            options += ':' + (self.cropper.model_fingerprint() if hasattr(self.cropper, 'model_fingerprint') else type(self.cropper).__name__)
+        return hash_frames(driving_images_np) + '-' + hashlib.blake2b(options.encode(), digest_size=8).hexdigest()
+
+    def prepare_driving(self, driving_images_np) -> dict:
+        """ run the driving-dependent stages on the whole clip, batch_size frames at a time
+        """
+        return self.concat_driving([chunk if isinstance(chunk, dict) else self.prepare_driving_chunk(chunk)
+                                    for chunk in self.iter_driving_chunks(driving_images_np)])
+
+    def extract_motion(self, driving_images_np, fps=0.) -> MotionTrack:
+        """ the motion of the driving frames as a MotionTrack, to render later without the frames
+        goes through the motion_cache like execute_iter
+        """
+        motion_key = self.motion_cache_key(driving_images_np) if self.motion_cache is not None else None
+        driving = self.motion_cache.get(motion_key, self.live_portrait_wrapper.device) if motion_key is not None else None
+        if driving is None:
+            with self.live_portrait_wrapper.cpu_threads():
+                driving = self.prepare_driving(driving_images_np)
+            if motion_key is not None:
+                self.motion_cache.put(motion_key, driving)
+        return MotionTrack.from_driving(driving, fps=fps)
+
+    def get_pasteback_backend(self) -> str:
+        """ 'auto' composites on the device of G unless that is the cpu, where the ROI remap is faster than torch """
+        backend = getattr(self.live_portrait_wrapper.cfg, 'pasteback_backend', 'auto')
+        if backend == 'auto':
+            return 'roi' if self.live_portrait_wrapper.device.type == 'cpu' else 'torch'
+        return backend
+
+    def get_outputs(self):
+        """ (crops, full): whether execute_iter produces the crops and the pasted-back frames, from inference_cfg.output_mode
+        """
+        inference_cfg = self.live_portrait_wrapper.cfg # for convenience
+        output_mode = getattr(inference_cfg, 'output_mode', 'both')
+        return output_mode != 'full', inference_cfg.flag_pasteback and output_mode != 'crops'
+
+    def get_batch_size(self) -> int:
+        return max(int(getattr(self.live_portrait_wrapper.cfg, 'batch_size', 1)), 1)
+
+    def compose_keypoints(self, source, driving, driving_0=None) -> torch.Tensor:
+        """ the driving keypoints x'_d,i of every frame for one source, Algorithm 1 in the paper
+        the whole clip (or chunk) goes through each stage as one batch, the branch is chosen once
+        driving_0: x_d_info and R_d of the first driving frame, when driving is a later chunk of the clip
+        return: Txnum_kpx3
+        """
+        inference_cfg = self.live_portrait_wrapper.cfg # for convenience
+        source_lmk, lip_delta_before_animation = source['source_lmk'], source['lip_delta_before_animation']
+        n_frames = driving['R_d'].shape[0]
+        x_s = source['x_s'].expand(n_frames, -1, -1)  # broadcast, the stitching/retargeting MLPs take paired batches
+
+        x_d_0_info, R_d_0 = (None, None) if driving_0 is None else (driving_0['x_d_info'], driving_0['R_d'])
+        x_d_new = compose_driving_keypoints(source['x_s_info'], source['R_s'], driving['x_d_info'], driving['R_d'],
+                                            flag_relative=inference_cfg.flag_relative, x_d_0_info=x_d_0_info, R_d_0=R_d_0)
+
+        # Algorithm 1:
+        if not inference_cfg.flag_stitching and not inference_cfg.flag_eye_retargeting and not inference_cfg.flag_lip_retargeting:
+            # without stitching or retargeting
+            if lip_delta_before_animation is not None:
+                x_d_new += lip_delta_before_animation.reshape(-1, x_s.shape[1], 3)
+        elif inference_cfg.flag_stitching and not inference_cfg.flag_eye_retargeting and not inference_cfg.flag_lip_retargeting:
+            # with stitching and without retargeting
+            if lip_delta_before_animation is not None:
+                x_d_new = self.live_portrait_wrapper.stitching(x_s, x_d_new) + lip_delta_before_animation.reshape(-1, x_s.shape[1], 3)
             else:
-                eyes_delta, lip_delta = None, None
-                if inference_cfg.flag_eye_retargeting:
-                    c_d_eyes_i = input_eye_ratio_lst[i]
-                    combined_eye_ratio_tensor = self.live_portrait_wrapper.calc_combined_eye_ratio(c_d_eyes_i, source_lmk)
-                    combined_eye_ratio_tensor = combined_eye_ratio_tensor * inference_cfg.eyes_retargeting_multiplier
-                    # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
-                    eyes_delta = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor)
-                if inference_cfg.flag_lip_retargeting:
-                    c_d_lip_i = input_lip_ratio_lst[i]
-                    combined_lip_ratio_tensor = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_i, source_lmk)
-                    combined_lip_ratio_tensor = combined_lip_ratio_tensor * inference_cfg.lip_retargeting_multiplier
-                    # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
-                    lip_delta = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor)
-
-                if inference_cfg.flag_relative:  # use x_s
-                    x_d_i_new = x_s + \
-                        (eyes_delta.reshape(-1, x_s.shape[1], 3) if eyes_delta is not None else 0) + \
-                        (lip_delta.reshape(-1, x_s.shape[1], 3) if lip_delta is not None else 0)
-                else:  # use x_d,i
-                    x_d_i_new = x_d_i_new + \
-                        (eyes_delta.reshape(-1, x_s.shape[1], 3) if eyes_delta is not None else 0) + \
-                        (lip_delta.reshape(-1, x_s.shape[1], 3) if lip_delta is not None else 0)
-
-                if inference_cfg.flag_stitching:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
-
-            out = self.live_portrait_wrapper.warp_decode(f_s, x_s, x_d_i_new)
-            I_p_i = self.live_portrait_wrapper.parse_output(out['out'])[0]
-            I_p_lst.append(I_p_i)
-            pbar.update(1)
-
-            #if inference_cfg.flag_pasteback:
-            I_p_i_to_ori = _transform_img(I_p_i, crop_info['M_c2o'], dsize=(img_rgb.shape[1], img_rgb.shape[0]))
-            I_p_i_to_ori_blend = np.clip(mask_ori * I_p_i_to_ori + (1 - mask_ori) * img_rgb, 0, 255).astype(np.uint8)
-            out = np.hstack([I_p_i_to_ori, I_p_i_to_ori_blend])
-            I_p_paste_lst.append(I_p_i_to_ori_blend)
-
-        return I_p_lst, I_p_paste_lst
+                x_d_new = self.live_portrait_wrapper.stitching(x_s, x_d_new)
+        else:
+            eyes_delta, lip_delta = None, None
+            if inference_cfg.flag_eye_retargeting:
+                combined_eye_ratio_tensor = self.live_portrait_wrapper.calc_combined_eye_ratios(driving['input_eye_ratio'], source_lmk)
+                combined_eye_ratio_tensor = combined_eye_ratio_tensor * inference_cfg.eyes_retargeting_multiplier
+                # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
+                eyes_delta = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor)
+            if inference_cfg.flag_lip_retargeting:
+                combined_lip_ratio_tensor = self.live_portrait_wrapper.calc_combined_lip_ratios(driving['input_lip_ratio'], source_lmk)
+                combined_lip_ratio_tensor = combined_lip_ratio_tensor * inference_cfg.lip_retargeting_multiplier
+                # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
+                lip_delta = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor)
+
+            if inference_cfg.flag_relative:  # use x_s
+                x_d_new = x_s + \
+                    (eyes_delta.reshape(-1, x_s.shape[1], 3) if eyes_delta is not None else 0) + \
+                    (lip_delta.reshape(-1, x_s.shape[1], 3) if lip_delta is not None else 0)
+            else:  # use x_d,i
+                x_d_new = x_d_new + \
+                    (eyes_delta.reshape(-1, x_s.shape[1], 3) if eyes_delta is not None else 0) + \
+                    (lip_delta.reshape(-1, x_s.shape[1], 3) if lip_delta is not None else 0)
+
+            if inference_cfg.flag_stitching:
+                x_d_new = self.live_portrait_wrapper.stitching(x_s, x_d_new)
+
+        return x_d_new
+
+    def paste_back(self, source, I_p_i):
+        img_rgb, mask_ori = source['img_rgb'], source['mask_ori']
+        I_p_i_to_ori = _transform_img(I_p_i, source['M_c2o'], dsize=(img_rgb.shape[1], img_rgb.shape[0]))
+        I_p_i_to_ori_blend = np.clip(mask_ori * I_p_i_to_ori + (1 - mask_ori) * img_rgb, 0, 255).astype(np.uint8)
+        return I_p_i_to_ori_blend
+
+    def paste_back_batch(self, source, out, I_p_batch, as_tensor=False, as_patches=False):
+        """ paste back a batch of frames of one source
+        out: Bx3x512x512, the output of G on the device; I_p_batch: BxHxWx3, uint8, the same frames on the host
+        return: a list of HxWx3 uint8 frames, or a BxHxWx3 float tensor in 0~1 for the torch paste-back with as_tensor
+        as_patches: only the pixels of source['paste_roi'] instead, Bxh_roixw_roix3 uint8, a tensor or an array
+        """
+        paste_back = source['paste_back']
+        if as_patches:
+            if isinstance(paste_back, TorchPasteBack):
+                return paste_back(out, roi_only=True).cpu()  # only the ROI is read back
+            if isinstance(paste_back, RoiPasteBack):
+                return np.stack([paste_back.patch(I_p_i) for I_p_i in I_p_batch])
+            roi = source['paste_roi']
+            if roi is None:
+                return np.empty((len(I_p_batch), 0, 0, 3), dtype=np.uint8)
+            return np.stack([self.paste_back(source, I_p_i)[roi] for I_p_i in I_p_batch])
+        if isinstance(paste_back, TorchPasteBack):
+            if as_tensor:
+                return paste_back(out, dtype=torch.float32).cpu()
+            return list(paste_back(out).cpu().numpy())  # composited on the device, one readback
+        if isinstance(paste_back, RoiPasteBack):
+            return [paste_back(I_p_i) for I_p_i in I_p_batch]
+        return [self.paste_back(source, I_p_i) for I_p_i in I_p_batch]
+
+    def execute(self, img_rgb, driving_images_np, crop_cfg=None):
+        return self.execute_multi([img_rgb], driving_images_np, crop_cfg)[0]
+
+    def execute_multi(self, img_rgb_lst, driving_images_np, crop_cfg=None):
+        """ animate several reference portraits with the same driving frames, see execute_iter
+        return: a list of (I_p_lst, I_p_paste_lst), one per source
+        """
+        I_p_lsts = [[] for _ in img_rgb_lst]
+        I_p_paste_lsts = [[] for _ in img_rgb_lst]
+        for step in self.execute_iter(img_rgb_lst, driving_images_np, crop_cfg):
+            for j, source_index in enumerate(step['source_indices']):
+                I_p_lsts[source_index].extend(step['I_p'][j])
+                I_p_paste_lsts[source_index].extend(step['I_p_paste'][j])
+        return list(zip(I_p_lsts, I_p_paste_lsts))
+
+    def execute_iter(self, img_rgb_lst, driving_images_np, crop_cfg=None, as_tensor=False, as_patches=False):
+        """ animate several reference portraits with the same driving frames, yielding the frames as they are produced
+        img_rgb_lst: HxWx3 uint8 source images, or prepare_source dicts of sources encoded before
+        the sources are batched together through W and G, at most inference_cfg.source_batch_size sources
+        times inference_cfg.batch_size frames per step; the driving motion is extracted once, by the first group
+        yields one dict per step: {
+            'source_indices': the indices in img_rgb_lst of the sources of the step,
+            'frame_index': the index of the first driving frame of the step, 'n_frames': the number of frames,
+            'I_p': per source, n_framesx512x512x3 uint8 crops, 'I_p_paste': per source, list of HxWx3 uint8 frames
+        }
+        an output that is not produced (see get_outputs) is an empty list for every source, and its work is skipped
+        driving_images_np: TxHxWx3, a uint8 array, or a float 0~1 tensor (ComfyUI IMAGE) that is resized chunk by chunk
+        on the device without going through numpy, a utils.video.DrivingVideo decoded chunk by chunk, or a
+        utils.motion_track.MotionTrack (or the path of its .npz) whose motion is used as is, without M
+        as_tensor: 'I_p' as float 0~1 tensors on the cpu instead, 'I_p_paste' too when the paste-back runs on the device
+        as_patches: 'I_p_paste' as per source n_framesxh_roixw_roix3 uint8 patches of the region the paste-back changes,
+        see PatchFrames; the steps then also have 'paste_roi': per source (img_rgb, (slice y, slice x) or None)
+        the memory in flight is bounded by the chunk size and the queue depth, not by the clip length
+        with a motion_cache, driving frames seen before skip M and the retargeting landmarks and go straight to rendering
+        """
+        with self.live_portrait_wrapper.cpu_threads():
+            yield from self._execute_iter(img_rgb_lst, driving_images_np, crop_cfg, as_tensor, as_patches)
+
+    def _execute_iter(self, img_rgb_lst, driving_images_np, crop_cfg=None, as_tensor=False, as_patches=False):
+        inference_cfg = self.live_portrait_wrapper.cfg # for convenience
+        if isinstance(driving_images_np, str):
+            driving_images_np = MotionTrack.load(driving_images_np)
+        if isinstance(driving_images_np, MotionTrack) and (inference_cfg.flag_eye_retargeting or inference_cfg.flag_lip_retargeting) \
+                and not driving_images_np.has_ratios:
+            raise ValueError('The eye/lip retargeting needs a MotionTrack with eye and lip ratios')
+        n_frames = len(driving_images_np)
+        source_batch_size = max(int(getattr(inference_cfg, 'source_batch_size', 1)), 1)
+
+        driving_chunks = []  # the motion of every chunk, filled by the first group and reused by the others
+        motion_key = None
+        if self.motion_cache is not None and not isinstance(driving_images_np, MotionTrack):
+            motion_key = self.motion_cache_key(driving_images_np)
+        cached = self.motion_cache.get(motion_key, self.live_portrait_wrapper.device) if motion_key is not None else None
+        if cached is not None:
+            log(f'Driving motion of {n_frames} frames from the cache')
+            driving_chunks = self.split_driving(cached, self.get_batch_size())
+
+        pbar = comfy.utils.ProgressBar(n_frames * len(img_rgb_lst))
+        for b in range(0, len(img_rgb_lst), source_batch_size):
+            sources = [self.source_to(img_rgb, self.live_portrait_wrapper.device) if isinstance(img_rgb, dict) else self.prepare_source(img_rgb, crop_cfg)
+                       for img_rgb in img_rgb_lst[b:b + source_batch_size]]
+            extract = b == 0 and cached is None
+            items = self.iter_driving_chunks(driving_images_np) if extract else iter(driving_chunks)
+
+            frame_index = 0
+            for step in track(self.animate(sources, items, driving_chunks if extract else None, as_tensor, as_patches), description='Animating...',
+                              total=(n_frames + self.get_batch_size() - 1) // self.get_batch_size()):
+                step['source_indices'] = list(range(b, b + len(sources)))
+                step['frame_index'] = frame_index
+                if as_patches:
+                    step['paste_roi'] = [(source['img_rgb'], source['paste_roi']) for source in sources]
+                frame_index += step['n_frames']
+                yield step
+                pbar.update(len(sources) * step['n_frames'])
+
+            if extract and motion_key is not None:
+                self.motion_cache.put(motion_key, self.concat_driving(driving_chunks))
+
+    def animate(self, sources, items, driving_chunks=None, as_tensor=False, as_patches=False):
+        """ generator over the chunks of driving frames for a group of sources, run as a pipeline of four stages
+        on successive chunks (see PipelinedExecutor):
+            motion: M and the retargeting ratios of the chunk (skipped for items that are already motion dicts),
+                    then the driving keypoints of every source
+            render: W and G for every source at once, on the device
+            readback: the crops to the host, and the paste-back when it runs on the device
+            paste: the paste-back on the host
+        items: chunks of driving frames (HxWx3 uint8), or prepare_driving_chunk dicts
+        driving_chunks: a list that collects the motion dicts of the chunks, to animate other sources later
+        as_tensor, as_patches: see execute_iter
+        yields: {'n_frames', 'I_p': per source list of 512x512x3 uint8, 'I_p_paste': per source list of HxWx3 uint8}
+        """
+        inference_cfg = self.live_portrait_wrapper.cfg # for convenience
+        f_s = torch.cat([source['f_s'] for source in sources], dim=0)
+        x_s = torch.cat([source['x_s'] for source in sources], dim=0)
+        # the source-only part of W is computed once for the group, the frames broadcast against it
+        prepared_source = self.live_portrait_wrapper.prepare_warp_source(f_s, x_s)
+        anchor = {}  # the motion of the first driving frame, for the relative motion of the later chunks
+
+        def motion(item):
+            driving = item if isinstance(item, dict) else self.prepare_driving_chunk(item)
+            if driving_chunks is not None:
+                driving_chunks.append(driving)
+            if not anchor:
+                anchor.update(x_d_info={k: v[0:1] for k, v in driving['x_d_info'].items()}, R_d=driving['R_d'][0:1])
+            # source-major: [s0 f_i..f_i+bs, s1 f_i..f_i+bs, ...]
+            x_d_new = torch.cat([self.compose_keypoints(source, driving, anchor) for source in sources], dim=0)
+            return {'n_frames': driving['n_frames'], 'x_d_new': x_d_new}
+
+        def render(step):
+            step['out'] = self.live_portrait_wrapper.warp_decode(None, None, step.pop('x_d_new'), prepared_source=prepared_source)['out']
+            return step
+
+        want_crops, want_full = self.get_outputs()
+        host_paste = want_full and any(not isinstance(source['paste_back'], TorchPasteBack) for source in sources)
+
+        def readback(step):
+            bs, out = step['n_frames'], step.pop('out')
+            # one readback per step, none at all when only the device paste-back is wanted
+            I_p_batch = I_p_uint8 = None
+            if want_crops and as_tensor:
+                I_p_batch = out.clamp(0, 1).permute(0, 2, 3, 1).contiguous().cpu()  # BxHxWx3, 0~1
+                if host_paste:
+                    I_p_uint8 = (I_p_batch * 255).to(torch.uint8).numpy()
+            elif want_crops or host_paste:
+                I_p_batch = I_p_uint8 = self.live_portrait_wrapper.parse_output(out)
+            step['I_p'] = [I_p_batch[j * bs:(j + 1) * bs] if want_crops else [] for j in range(len(sources))]
+            step['I_p_uint8'] = [None if I_p_uint8 is None else I_p_uint8[j * bs:(j + 1) * bs] for j in range(len(sources))]
+            step['I_p_paste'] = [[] for _ in sources]
+            if want_full:
+                for j, source in enumerate(sources):
+                    if isinstance(source['paste_back'], TorchPasteBack):
+                        step['I_p_paste'][j] = self.paste_back_batch(source, out[j * bs:(j + 1) * bs], None, as_tensor, as_patches)
+            return step
+
+        def paste(step):
+            I_p_uint8 = step.pop('I_p_uint8')
+            if host_paste:
+                for j, source in enumerate(sources):
+                    if not isinstance(source['paste_back'], TorchPasteBack):
+                        step['I_p_paste'][j] = self.paste_back_batch(source, None, I_p_uint8[j], as_patches=as_patches)
+            return step
+
+        executor = PipelinedExecutor([('motion', motion), ('render', render), ('readback', readback), ('paste', paste)],
+                                     queue_depth=getattr(inference_cfg, 'pipeline_queue_depth', 2), name='Animating')
+        yield from executor.run(items)
+        executor.report()
+        self.stage_stats = executor.stats
@@ -5,9 +5,12 @@ Wrapper for LivePortrait core functions
 """
 
 import os.path as osp
+import contextlib
+from functools import lru_cache
 import numpy as np
 import cv2
 import torch
+import torch.nn.functional as F
 import yaml
 
 from .utils.timer import Timer
@@ -19,6 +22,14 @@ from .config.inference_config import InferenceConfig
 from .utils.rprint import rlog as log
 
 
+@lru_cache(maxsize=None)
+def cpu_supports_bf16() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
 class LivePortraitWrapper(object):
 
     def __init__(self, appearance_feature_extractor, motion_extractor, warping_module,
@@ -32,8 +43,39 @@ class LivePortraitWrapper(object):
 
         self.cfg = cfg
         self.device_id = cfg.device_id
+        self.device = next(appearance_feature_extractor.parameters()).device  # every input follows the networks
         self.timer = Timer()
 
+    @contextlib.contextmanager
+    def cpu_threads(self):
+        """ torch intra-op threads of cfg.num_threads when running on the cpu, for the duration of the context only:
+        the setting is process-wide, so the previous count is restored for the other nodes
+        """
+        num_threads = getattr(self.cfg, 'num_threads', 0)
+        previous = torch.get_num_threads()
+        if self.device.type != 'cpu' or num_threads <= 0 or num_threads == previous:
+            yield
+            return
+        torch.set_num_threads(num_threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous)
+
+    def autocast(self):
+        """ the mixed precision context of F, M, W and G when flag_use_half_precision is set
+        half_precision_dtype 'auto': float16 on CUDA, float32 elsewhere
+        half_precision_dtype 'bfloat16': bfloat16 on CUDA, and on CPUs with native bf16 support
+        """
+        half_precision_dtype = getattr(self.cfg, 'half_precision_dtype', 'auto')
+        if not self.cfg.flag_use_half_precision:
+            return contextlib.nullcontext()
+        if half_precision_dtype == 'bfloat16' and (self.device.type == 'cuda' or (self.device.type == 'cpu' and cpu_supports_bf16())):
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        if half_precision_dtype == 'auto' and self.device.type == 'cuda':
+            return torch.autocast(device_type='cuda', dtype=torch.float16)
+        return contextlib.nullcontext()
+
     def update_config(self, user_args):
         for k, v in user_args.items():
             if hasattr(self.cfg, k):
@@ -57,33 +99,48 @@ class LivePortraitWrapper(object):
             raise ValueError(f'img ndim should be 3 or 4: {x.ndim}')
         x = np.clip(x, 0, 1)  # clip to 0~1
         x = torch.from_numpy(x).permute(0, 3, 1, 2)  # 1xHxWx3 -> 1x3xHxW
-        x = x.cuda(self.device_id)
+        x = x.to(self.device)
         return x
 
     def prepare_driving_videos(self, imgs) -> torch.Tensor:
         """ construct the input as standard
-        imgs: NxBxHxWx3, uint8
+        imgs: NxBxHxWx3, uint8, or a list of HxWx3 uint8 frames
+        uint8 frames are uploaded as is and normalized on the device, a quarter of the float32 transfer
         """
         if isinstance(imgs, list):
-            _imgs = np.array(imgs)[..., np.newaxis]  # TxHxWx3x1
+            _imgs = np.stack(imgs)[..., np.newaxis]  # TxHxWx3x1
         elif isinstance(imgs, np.ndarray):
             _imgs = imgs
         else:
             raise ValueError(f'imgs type error: {type(imgs)}')
 
-        y = _imgs.astype(np.float32) / 255.
-        y = np.clip(y, 0, 1)  # clip to 0~1
-        y = torch.from_numpy(y).permute(0, 4, 3, 1, 2)  # TxHxWx3x1 -> Tx1x3xHxW
-        y = y.cuda(self.device_id)
+        if _imgs.dtype == np.uint8:
+            y = torch.from_numpy(np.ascontiguousarray(_imgs)).to(self.device)
+            y = y.permute(0, 4, 3, 1, 2).float().div_(255.)  # TxHxWx3x1 -> Tx1x3xHxW, normalized to 0~1
+        else:
+            y = _imgs.astype(np.float32) / 255.
+            y = np.clip(y, 0, 1)  # clip to 0~1
+            y = torch.from_numpy(y).permute(0, 4, 3, 1, 2)  # TxHxWx3x1 -> Tx1x3xHxW
+            y = y.to(self.device)
 
         return y
 
+    def prepare_driving_images(self, images: torch.Tensor) -> torch.Tensor:
+        """ construct the input of M from ComfyUI IMAGE frames, resized on the device
+        images: TxHxWx3, float 0~1
+        return: Tx3xHxW at input_shape
+        """
+        x = images.to(self.device).permute(0, 3, 1, 2)  # TxHxWx3 -> Tx3xHxW
+        if tuple(x.shape[2:]) != tuple(self.cfg.input_shape):
+            x = F.interpolate(x, size=tuple(self.cfg.input_shape), mode='bilinear', align_corners=False)  # same sampling as cv2.INTER_LINEAR
+        return x.clamp(0, 1)
+
     def extract_feature_3d(self, x: torch.Tensor) -> torch.Tensor:
         """ get the appearance feature of the image by F
         x: Bx3xHxW, normalized to 0~1
         """
         with torch.no_grad():
-            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=self.cfg.flag_use_half_precision):
+            with self.autocast():
                 feature_3d = self.appearance_feature_extractor(x)
 
         return feature_3d.float()
@@ -95,7 +152,7 @@ class LivePortraitWrapper(object):
         return: A dict contains keys: 'pitch', 'yaw', 'roll', 't', 'exp', 'scale', 'kp'
         """
         with torch.no_grad():
-            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=self.cfg.flag_use_half_precision):
+            with self.autocast():
                 kp_info = self.motion_extractor(x)
 
             if self.cfg.flag_use_half_precision:
@@ -262,17 +319,30 @@ class LivePortraitWrapper(object):
 
         return kp_driving
 
-    def warp_decode(self, feature_3d: torch.Tensor, kp_source: torch.Tensor, kp_driving: torch.Tensor) -> torch.Tensor:
+    def prepare_warp_source(self, feature_3d: torch.Tensor, kp_source: torch.Tensor) -> dict:
+        """ precompute the source-only part of W once, to be passed to warp_decode for every frame
+        feature_3d: Nx32x16x64x64, feature volume
+        kp_source: NxKx3
+        """
+        with torch.no_grad():
+            with self.autocast():
+                prepared_source = self.warping_module.prepare_source(feature_3d, kp_source)
+
+        return prepared_source
+
+    def warp_decode(self, feature_3d: torch.Tensor, kp_source: torch.Tensor, kp_driving: torch.Tensor, prepared_source: dict = None) -> torch.Tensor:
         """ get the image after the warping of the implicit keypoints
         feature_3d: Bx32x16x64x64, feature volume
         kp_source: BxNx3
         kp_driving: BxNx3
+        prepared_source: from prepare_warp_source, replaces feature_3d and kp_source; with N sources,
+        kp_driving holds B // N consecutive frames per source
         """
         # The line 18 in Algorithm 1: D(W(f_s; x_s, x′_d,i)）
         with torch.no_grad():
-            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=self.cfg.flag_use_half_precision):
+            with self.autocast():
                 # get decoder input
-                ret_dct = self.warping_module(feature_3d, kp_source=kp_source, kp_driving=kp_driving)
+                ret_dct = self.warping_module(feature_3d, kp_source=kp_source, kp_driving=kp_driving, prepared_source=prepared_source)
                 # decode
                 ret_dct['out'] = self.spade_generator(feature=ret_dct['out'])
 
@@ -306,18 +376,40 @@ class LivePortraitWrapper(object):
 
     def calc_combined_eye_ratio(self, input_eye_ratio, source_lmk):
         eye_close_ratio = calc_eye_close_ratio(source_lmk[None])
-        eye_close_ratio_tensor = torch.from_numpy(eye_close_ratio).float().cuda(self.device_id)
-        input_eye_ratio_tensor = torch.Tensor([input_eye_ratio[0][0]]).reshape(1, 1).cuda(self.device_id)
+        eye_close_ratio_tensor = torch.from_numpy(eye_close_ratio).float().to(self.device)
+        input_eye_ratio_tensor = torch.Tensor([input_eye_ratio[0][0]]).reshape(1, 1).to(self.device)
         # [c_s,eyes, c_d,eyes,i]
         combined_eye_ratio_tensor = torch.cat([eye_close_ratio_tensor, input_eye_ratio_tensor], dim=1)
         return combined_eye_ratio_tensor
 
     def calc_combined_lip_ratio(self, input_lip_ratio, source_lmk):
         lip_close_ratio = calc_lip_close_ratio(source_lmk[None])
-        lip_close_ratio_tensor = torch.from_numpy(lip_close_ratio).float().cuda(self.device_id)
+        lip_close_ratio_tensor = torch.from_numpy(lip_close_ratio).float().to(self.device)
         # [c_s,lip, c_d,lip,i]
-        input_lip_ratio_tensor = torch.Tensor([input_lip_ratio[0]]).cuda(self.device_id)
+        input_lip_ratio_tensor = torch.Tensor([input_lip_ratio[0]]).to(self.device)
         if input_lip_ratio_tensor.shape != [1, 1]:
             input_lip_ratio_tensor = input_lip_ratio_tensor.reshape(1, 1)
         combined_lip_ratio_tensor = torch.cat([lip_close_ratio_tensor, input_lip_ratio_tensor], dim=1)
         return combined_lip_ratio_tensor
+
+    def calc_combined_eye_ratios(self, input_eye_ratios: np.ndarray, source_lmk):
+        """ calc_combined_eye_ratio for a whole clip
+        input_eye_ratios: Tx1, the driving eye-close ratio of every frame
+        return: Tx3
+        """
+        eye_close_ratio = calc_eye_close_ratio(source_lmk[None])
+        eye_close_ratio_tensor = torch.from_numpy(eye_close_ratio).float().to(self.device)
+        input_eye_ratio_tensor = torch.from_numpy(np.asarray(input_eye_ratios).reshape(-1, 1)).float().to(self.device)
+        # [c_s,eyes, c_d,eyes,i]
+        return torch.cat([eye_close_ratio_tensor.expand(input_eye_ratio_tensor.shape[0], -1), input_eye_ratio_tensor], dim=1)
+
+    def calc_combined_lip_ratios(self, input_lip_ratios: np.ndarray, source_lmk):
+        """ calc_combined_lip_ratio for a whole clip
+        input_lip_ratios: Tx1, the driving lip-close ratio of every frame
+        return: Tx2
+        """
+        lip_close_ratio = calc_lip_close_ratio(source_lmk[None])
+        lip_close_ratio_tensor = torch.from_numpy(lip_close_ratio).float().to(self.device)
+        input_lip_ratio_tensor = torch.from_numpy(np.asarray(input_lip_ratios).reshape(-1, 1)).float().to(self.device)
+        # [c_s,lip, c_d,lip,i]
+        return torch.cat([lip_close_ratio_tensor.expand(input_lip_ratio_tensor.shape[0], -1), input_lip_ratio_tensor], dim=1)
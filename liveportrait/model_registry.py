@@ -0,0 +1,289 @@
+# coding: utf-8
+
+"""
+Process-wide registry of the LivePortrait networks (F, M, W, G and the stitching/retargeting heads),
+so that every pipeline built from the same weights on the same device shares one copy of them
+"""
+
+import hashlib
+import os
+import os.path as osp
+import threading
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+
+import yaml
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .modules.spade_generator import SPADEDecoder
+from .modules.warping_network import WarpingNetwork
+from .modules.motion_extractor import MotionExtractor
+from .modules.appearance_feature_extractor import AppearanceFeatureExtractor
+from .modules.stitching_retargeting_network import StitchingRetargetingNetwork
+from .modules.util import freeze_for_inference
+from .utils.rprint import rlog as log
+
+import comfy.utils
+
+
+def make_abs_path(fn):
+    return osp.join(osp.dirname(osp.realpath(__file__)), fn)
+
+
+# budget for the weights kept alive by the registry, 0 means unlimited
+DEFAULT_BUDGET_MB = int(os.environ.get('LIVEPORTRAIT_MODEL_CACHE_MB', 2048))
+
+# F, W and G are frozen for inference on load (see freeze_for_inference); the frozen weights are written next to
+# the originals as <model_type>.frozen.safetensors once they pass the parity check, set to 0 to never write them;
+# a frozen file records the size and hash of the checkpoint it was baked from and is only used while they match
+SAVE_FROZEN = os.environ.get('LIVEPORTRAIT_SAVE_FROZEN', '1') != '0'
+FROZEN_MODEL_TYPES = ('appearance_feature_extractor', 'warping_module', 'spade_generator')
+FROZEN_PARITY_RTOL = 1e-4
+
+
+@lru_cache(maxsize=None)
+def load_model_config(model_config_path=make_abs_path('./config/models.yaml')) -> dict:
+    with open(model_config_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def filter_checkpoint_for_model(checkpoint, prefix):
+    """Filter and adjust the checkpoint dictionary for a specific model based on the prefix."""
+    # Create a new dictionary where keys are adjusted by removing the prefix and the model name
+    filtered_checkpoint = {key.replace(prefix + "_module.", ""): value for key, value in checkpoint.items() if key.startswith(prefix)}
+    return filtered_checkpoint
+
+
+def frozen_checkpoint_path(model_path, model_type):
+    return osp.join(model_path, f'{model_type}.frozen.safetensors')
+
+
+def checkpoint_fingerprint(ckpt_path) -> str:
+    """ size and blake2b of a checkpoint file, what a frozen file is baked from """
+    h = hashlib.blake2b(digest_size=16)
+    with open(ckpt_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return f'{osp.getsize(ckpt_path)}:{h.hexdigest()}'
+
+
+def frozen_is_current(frozen_path, fingerprint) -> bool:
+    """ the frozen file exists and was baked from the checkpoint of this fingerprint """
+    if not osp.exists(frozen_path):
+        return False
+    try:
+        with safe_open(frozen_path, framework='pt') as f:
+            metadata = f.metadata() or {}
+    except Exception as e:
+        log(f'Could not read {frozen_path}: {e}')
+        return False
+    return metadata.get('source_fingerprint') == fingerprint
+
+
+def make_parity_inputs(model_type, model_params, seed=0):
+    """ small random inputs of F, W or G for the frozen/original parity check, as forward kwargs
+    """
+    generator = torch.Generator().manual_seed(seed)
+    if model_type == 'appearance_feature_extractor':
+        return {'source_image': torch.rand(1, model_params['image_channel'], 64, 64, generator=generator)}
+    if model_type == 'warping_module':
+        num_kp = model_params['num_kp']
+        return {
+            'feature_3d': torch.randn(1, model_params['reshape_channel'], model_params['dense_motion_params']['reshape_depth'], 32, 32, generator=generator),
+            'kp_driving': torch.rand(1, num_kp, 3, generator=generator) * 2 - 1,
+            'kp_source': torch.rand(1, num_kp, 3, generator=generator) * 2 - 1,
+        }
+    if model_type == 'spade_generator':
+        input_channels = min(model_params['max_features'], model_params['block_expansion'] * (2 ** model_params['num_down_blocks']))
+        return {'feature': torch.randn(1, input_channels, 32, 32, generator=generator)}
+    raise ValueError(f'Unknown model type: {model_type}')
+
+
+def _parity_output(model, inputs):
+    out = model(**inputs)
+    return out['out'] if isinstance(out, dict) else out
+
+
+@torch.no_grad()
+def bake_frozen_model(model, model_type, model_params, frozen_path=None, fingerprint=None):
+    """ freeze model for inference and check it against the original on random inputs
+    the frozen weights are saved to frozen_path if given, with the fingerprint of the source checkpoint;
+    if the check fails the original model is returned untouched
+    """
+    model.eval()
+    inputs = make_parity_inputs(model_type, model_params)
+    original_state = {k: v.clone() for k, v in model.state_dict().items()}
+    expected = _parity_output(model, inputs)
+
+    model = freeze_for_inference(model)
+    diff = (_parity_output(model, inputs) - expected).abs().max().item()
+    scale = max(expected.abs().max().item(), 1.0)
+    if diff > FROZEN_PARITY_RTOL * scale:
+        log(f'Frozen {model_type} does not match the original (max abs diff {diff:.3e}), keeping the original weights')
+        model = type(model)(**model_params)
+        model.load_state_dict(original_state)
+        return model.eval()
+    log(f'Frozen {model_type} for inference, max abs diff {diff:.3e}')
+
+    if frozen_path is not None:
+        tmp_path = frozen_path + '.tmp'
+        try:
+            save_file({k: v.contiguous() for k, v in model.state_dict().items()}, tmp_path,
+                      metadata={'source_fingerprint': fingerprint or ''})
+            os.replace(tmp_path, frozen_path)
+            log(f'Saved the frozen {model_type} to {frozen_path}')
+        except OSError as e:
+            log(f'Could not save the frozen {model_type} to {frozen_path}: {e}')
+    return model
+
+
+def build_models(model_path, device, dtype=torch.float32, pbar=None) -> dict:
+    """ construct F, M, W, G and S from the safetensors in model_path
+    return: A dict contains keys: 'appearance_feature_extractor', 'motion_extractor', 'warping_module', 'spade_generator', 'stitching_retargeting_module'
+    """
+    model_config = load_model_config()
+
+    def _load(model_cls, model_type):
+        model_params = model_config['model_params'][f'{model_type}_params']
+        model = model_cls(**model_params)
+        ckpt_path = osp.join(model_path, f'{model_type}.safetensors')
+        frozen_path = frozen_checkpoint_path(model_path, model_type)
+        # the fingerprint, not the mtime, ties a frozen file to its checkpoint: copies and snapshots keep or reset mtimes
+        fingerprint = checkpoint_fingerprint(ckpt_path) if model_type in FROZEN_MODEL_TYPES and (SAVE_FROZEN or osp.exists(frozen_path)) else None
+        if fingerprint is not None and frozen_is_current(frozen_path, fingerprint):
+            model = freeze_for_inference(model)
+            model.load_state_dict(comfy.utils.load_torch_file(frozen_path))
+        else:
+            model.load_state_dict(comfy.utils.load_torch_file(ckpt_path))
+            if model_type in FROZEN_MODEL_TYPES:
+                model = bake_frozen_model(model, model_type, model_params, frozen_path if SAVE_FROZEN else None, fingerprint)
+        model = model.to(device=device, dtype=dtype)
+        model.eval()
+        log(f'Load {model_type} done.')
+        if pbar is not None:
+            pbar.update(1)
+        return model
+
+    models = {
+        'appearance_feature_extractor': _load(AppearanceFeatureExtractor, 'appearance_feature_extractor'),  # F
+        'motion_extractor': _load(MotionExtractor, 'motion_extractor'),  # M
+        'warping_module': _load(WarpingNetwork, 'warping_module'),  # W
+        'spade_generator': _load(SPADEDecoder, 'spade_generator').fuse_spade(),  # G, with the SPADE mlp_shared convs fused
+    }
+
+    # S, three heads in one checkpoint
+    config = model_config['model_params']['stitching_retargeting_module_params']
+    checkpoint = comfy.utils.load_torch_file(osp.join(model_path, 'stitching_retargeting_module.safetensors'))
+    stitching_retargeting_module = {}
+    for name, prefix in (('stitching', 'retarget_shoulder'), ('lip', 'retarget_mouth'), ('eye', 'retarget_eye')):
+        module = StitchingRetargetingNetwork(**config.get(name))
+        module.load_state_dict(filter_checkpoint_for_model(checkpoint, prefix))
+        module = module.to(device=device, dtype=dtype)
+        module.eval()
+        stitching_retargeting_module[name] = module
+    log('Load stitching_retargeting_module done.')
+    models['stitching_retargeting_module'] = stitching_retargeting_module
+
+    return models
+
+
+def models_nbytes(models: dict) -> int:
+    storages = {}  # count the storage once when several parameters are views into it
+    for model in models.values():
+        for module in (model.values() if isinstance(model, dict) else [model]):
+            for t in list(module.parameters()) + list(module.buffers()):
+                storage = t.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+class _Entry(object):
+    def __init__(self, models, nbytes):
+        self.models = models
+        self.nbytes = nbytes
+        self.refcount = 0
+
+
+class ModelRegistry(object):
+    """ LRU cache of loaded networks keyed by (model directory, device, dtype)
+
+    Every pipeline handed out holds a reference on its entry until it is garbage collected.
+    Entries that are no longer referenced stay cached, and are evicted least-recently-used
+    first once the total size goes over the budget. Referenced entries are never evicted.
+    """
+
+    def __init__(self, budget_mb=DEFAULT_BUDGET_MB):
+        self.budget_bytes = int(budget_mb * 1024 ** 2)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(model_path, device, dtype=torch.float32):
+        return (osp.realpath(model_path), str(torch.device(device)), str(dtype))
+
+    def set_budget(self, budget_mb):
+        with self._lock:
+            self.budget_bytes = int(budget_mb * 1024 ** 2)
+            self.evict()
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def acquire(self, model_path, device, dtype=torch.float32, pbar=None):
+        """ return (key, models) and take a reference on the entry, loading the weights on a miss
+        """
+        key = self.make_key(model_path, device, dtype)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                models = build_models(model_path, device, dtype, pbar=pbar)
+                entry = _Entry(models, models_nbytes(models))
+                self._entries[key] = entry
+                log(f'LivePortrait models cached: {entry.nbytes / 1024 ** 2:.1f}MB for {key}')
+            self._entries.move_to_end(key)
+            entry.refcount += 1
+            self.evict()
+            return key, entry.models
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount = max(entry.refcount - 1, 0)
+            self.evict()
+
+    def bind(self, owner, key):
+        """ release the reference on key once owner is garbage collected
+        """
+        weakref.finalize(owner, self.release, key)
+        return owner
+
+    def evict(self):
+        with self._lock:
+            if self.budget_bytes <= 0:
+                return
+            total = self.total_bytes()
+            for key in list(self._entries.keys()):  # least recently used first
+                if total <= self.budget_bytes:
+                    break
+                entry = self._entries[key]
+                if entry.refcount > 0:
+                    continue
+                del self._entries[key]
+                total -= entry.nbytes
+                log(f'LivePortrait models evicted: {key}')
+
+    def clear(self):
+        """ drop every unreferenced entry
+        """
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry.refcount == 0]:
+                del self._entries[key]
+
+
+MODEL_REGISTRY = ModelRegistry()
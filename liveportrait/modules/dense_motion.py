@@ -10,6 +10,18 @@ import torch
 from .util import Hourglass, make_coordinate_grid, kp2gaussian
 
 
+def broadcast_source(x, bs):
+    """
+    (n, ...) -> (bs, ...), a view when n == 1, otherwise each of the n entries is repeated bs // n times
+    """
+    n = x.shape[0]
+    if n == bs:
+        return x
+    if n == 1:
+        return x.expand(bs, *x.shape[1:])
+    return x.repeat_interleave(bs // n, dim=0)
+
+
 class DenseMotionNetwork(nn.Module):
     def __init__(self, block_expansion, num_blocks, max_features, num_kp, feature_channel, reshape_depth, compress, estimate_occlusion_map=True):
         super(DenseMotionNetwork, self).__init__()
@@ -28,7 +40,7 @@ class DenseMotionNetwork(nn.Module):
 
     def create_sparse_motions(self, feature, kp_driving, kp_source):
         bs, _, d, h, w = feature.shape  # (bs, 4, 16, 64, 64)
-        identity_grid = make_coordinate_grid((d, h, w), ref=kp_source)  # (16, 64, 64, 3)
+        identity_grid = make_coordinate_grid((d, h, w), ref=kp_source)  # (16, 64, 64, 3), cached
         identity_grid = identity_grid.view(1, 1, d, h, w, 3)  # (1, 1, d=16, h=64, w=64, 3)
         coordinate_grid = identity_grid - kp_driving.view(bs, self.num_kp, 1, 1, 1, 3)
 
@@ -38,24 +50,34 @@ class DenseMotionNetwork(nn.Module):
         driving_to_source = coordinate_grid + kp_source.view(bs, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
 
         # adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, 1, d, h, w, 3)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)  # (bs, 1+num_kp, d, h, w, 3)
         return sparse_motions
 
     def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
-        sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3)
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions, align_corners=False)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
+        bs, c, d, h, w = feature.shape
+        # the num_kp+1 motions are stacked along the output depth, so the feature is sampled once per motion
+        # without materializing num_kp+1 copies of it; grid_sample is pointwise in the grid, the result is identical
+        sparse_motions = sparse_motions.reshape((bs, (self.num_kp+1) * d, h, w, 3))                    # (bs, (num_kp+1)*d, h, w, 3)
+        sparse_deformed = F.grid_sample(feature, sparse_motions, align_corners=False)                 # (bs, c, (num_kp+1)*d, h, w)
+        sparse_deformed = sparse_deformed.view((bs, c, self.num_kp+1, d, h, w)).transpose(1, 2)        # (bs, num_kp+1, c, d, h, w)
 
         return sparse_deformed
 
-    def create_heatmap_representations(self, feature, kp_driving, kp_source):
+    def create_deformation(self, sparse_motions, mask):
+        """
+        sum of the sparse motions weighted by the mask, one fused reduction over the motions that does not
+        materialize the (bs, num_kp+1, d, h, w, 3) product nor permute the motions
+        sparse_motions: (bs, num_kp+1, d, h, w, 3); mask: (bs, num_kp+1, d, h, w)
+        return: (bs, d, h, w, 3)
+        """
+        return torch.einsum('bkdhwc,bkdhw->bdhwc', sparse_motions, mask)
+
+    def create_heatmap_representations(self, feature, kp_driving, kp_source, gaussian_source=None):
         spatial_size = feature.shape[3:]  # (d=16, h=64, w=64)
         gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
-        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
+        if gaussian_source is None:
+            gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
         heatmap = gaussian_driving - gaussian_source  # (bs, num_kp, d, h, w)
 
         # adding background feature
@@ -64,12 +86,36 @@ class DenseMotionNetwork(nn.Module):
         heatmap = heatmap.unsqueeze(2)         # (bs, 1+num_kp, 1, d, h, w)
         return heatmap
 
-    def forward(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape  # (bs, 32, 16, 64, 64)
-
-        feature = self.compress(feature)  # (bs, 4, 16, 64, 64)
-        feature = self.norm(feature)  # (bs, 4, 16, 64, 64)
-        feature = F.relu(feature)  # (bs, 4, 16, 64, 64)
+    def prepare_source(self, feature, kp_source):
+        """
+        The parts that only depend on the source, computed once and reused for every driving frame
+        feature: (n, 32, 16, 64, 64); kp_source: (n, num_kp, 3)
+        """
+        feature = self.compress(feature)  # (n, 4, 16, 64, 64)
+        feature = self.norm(feature)  # (n, 4, 16, 64, 64)
+        feature = F.relu(feature)  # (n, 4, 16, 64, 64)
+
+        gaussian_source = kp2gaussian(kp_source, spatial_size=feature.shape[2:], kp_variance=0.01)  # (n, num_kp, d, h, w)
+        # the identity grid is cached by make_coordinate_grid
+
+        return {
+            'feature': feature,
+            'kp_source': kp_source,
+            'gaussian_source': gaussian_source,
+        }
+
+    def forward(self, feature, kp_driving, kp_source, prepared_source=None):
+        """
+        prepared_source: the output of prepare_source, with one entry per source; the bs driving keypoints are
+        source-major, bs // n consecutive entries per source
+        """
+        if prepared_source is None:
+            prepared_source = self.prepare_source(feature, kp_source)
+        bs = kp_driving.shape[0]
+        feature = broadcast_source(prepared_source['feature'], bs)  # (bs, 4, 16, 64, 64)
+        kp_source = broadcast_source(prepared_source['kp_source'], bs)
+        gaussian_source = broadcast_source(prepared_source['gaussian_source'], bs)
+        _, _, d, h, w = feature.shape
 
         out_dict = dict()
 
@@ -78,7 +124,7 @@ class DenseMotionNetwork(nn.Module):
         deformed_feature = self.create_deformed_feature(feature, sparse_motion)  # (bs, 1+num_kp, c=4, d=16, h=64, w=64)
 
         # 2. (bs, 1+num_kp, d, h, w)
-        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)  # (bs, 1+num_kp, 1, d, h, w)
+        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source, gaussian_source=gaussian_source)  # (bs, 1+num_kp, 1, d, h, w)
 
         input = torch.cat([heatmap, deformed_feature], dim=2)  # (bs, 1+num_kp, c=5, d=16, h=64, w=64)
         input = input.view(bs, -1, d, h, w)  # (bs, (1+num_kp)*c=105, d=16, h=64, w=64)
@@ -88,10 +134,7 @@ class DenseMotionNetwork(nn.Module):
         mask = self.mask(prediction)
         mask = F.softmax(mask, dim=1)  # (bs, 1+num_kp, d=16, h=64, w=64)
         out_dict['mask'] = mask
-        mask = mask.unsqueeze(2)                                   # (bs, num_kp+1, 1, d, h, w)
-        sparse_motion = sparse_motion.permute(0, 1, 5, 2, 3, 4)    # (bs, num_kp+1, 3, d, h, w)
-        deformation = (sparse_motion * mask).sum(dim=1)            # (bs, 3, d, h, w)  mask take effect in this place
-        deformation = deformation.permute(0, 2, 3, 4, 1)           # (bs, d, h, w, 3)
+        deformation = self.create_deformation(sparse_motion, mask)  # (bs, d, h, w, 3)  mask take effect in this place
 
         out_dict['deformation'] = deformation
 
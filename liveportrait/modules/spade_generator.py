@@ -38,20 +38,65 @@ class SPADEDecoder(nn.Module):
                 nn.PixelShuffle(upscale_factor=2)
             )
 
+        self.fused_mlp_shared = None
+
+    # blocks grouped by the resolution they run at, as a multiple of the 64x64 seg
+    SPADE_BLOCK_SCALES = {
+        1: ('G_middle_0', 'G_middle_1', 'G_middle_2', 'G_middle_3', 'G_middle_4', 'G_middle_5'),
+        2: ('up_0',),
+        4: ('up_1',),
+    }
+
+    @torch.no_grad()
+    def fuse_spade(self):
+        """ inference mode: concatenate the mlp_shared convs of every SPADE layer running at the same resolution
+        into one wide conv, evaluated once per forward on a segmap interpolated once per resolution
+        """
+        fused_mlp_shared = nn.ModuleDict()
+        for scale, block_names in self.SPADE_BLOCK_SCALES.items():
+            convs = [spade.mlp_shared[0] for name in block_names for _, spade in getattr(self, name).spade_layers()]
+            conv = nn.Conv2d(convs[0].in_channels, sum(c.out_channels for c in convs), kernel_size=convs[0].kernel_size, padding=convs[0].padding)
+            conv.weight.copy_(torch.cat([c.weight for c in convs], dim=0))
+            conv.bias.copy_(torch.cat([c.bias for c in convs], dim=0))
+            conv = conv.to(device=convs[0].weight.device, dtype=convs[0].weight.dtype)
+            # the per-layer convs become views into the fused weights, so nothing is stored twice
+            start = 0
+            for c in convs:
+                end = start + c.out_channels
+                c.weight = nn.Parameter(conv.weight[start:end], requires_grad=False)
+                c.bias = nn.Parameter(conv.bias[start:end], requires_grad=False)
+                start = end
+            fused_mlp_shared[str(scale)] = conv
+        self.fused_mlp_shared = fused_mlp_shared
+        return self
+
+    def fused_spade_actvs(self, seg):
+        """ the mlp_shared activations of every SPADE layer, {block name: {layer name: actv}}
+        """
+        actvs = {}
+        for scale, block_names in self.SPADE_BLOCK_SCALES.items():
+            segmap = seg if scale == 1 else F.interpolate(seg, size=(seg.shape[2] * scale, seg.shape[3] * scale), mode='nearest')
+            actv = F.relu(self.fused_mlp_shared[str(scale)](segmap))
+            chunks = iter(actv.split(self.G_middle_0.norm_0.mlp_shared[0].out_channels, dim=1))
+            for name in block_names:
+                actvs[name] = {layer_name: next(chunks) for layer_name, _ in getattr(self, name).spade_layers()}
+        return actvs
+
     def forward(self, feature):
         seg = feature  # Bx256x64x64
+        actvs = self.fused_spade_actvs(seg) if self.fused_mlp_shared is not None else {}
         x = self.fc(feature)  # Bx512x64x64
-        x = self.G_middle_0(x, seg)
-        x = self.G_middle_1(x, seg)
-        x = self.G_middle_2(x, seg)
-        x = self.G_middle_3(x, seg)
-        x = self.G_middle_4(x, seg)
-        x = self.G_middle_5(x, seg)
+        x = self.G_middle_0(x, seg, actvs.get('G_middle_0'))
+        x = self.G_middle_1(x, seg, actvs.get('G_middle_1'))
+        x = self.G_middle_2(x, seg, actvs.get('G_middle_2'))
+        x = self.G_middle_3(x, seg, actvs.get('G_middle_3'))
+        x = self.G_middle_4(x, seg, actvs.get('G_middle_4'))
+        x = self.G_middle_5(x, seg, actvs.get('G_middle_5'))
 
         x = self.up(x)  # Bx512x64x64 -> Bx512x128x128
-        x = self.up_0(x, seg)  # Bx512x128x128 -> Bx256x128x128
+        x = self.up_0(x, seg, actvs.get('up_0'))  # Bx512x128x128 -> Bx256x128x128
         x = self.up(x)  # Bx256x128x128 -> Bx256x256x256
-        x = self.up_1(x, seg)  # Bx256x256x256 -> Bx64x256x256
+        x = self.up_1(x, seg, actvs.get('up_1'))  # Bx256x256x256 -> Bx64x256x256
 
         x = self.conv_img(F.leaky_relu(x, 2e-1))  # Bx64x256x256 -> Bx3xHxW
         x = torch.sigmoid(x)  # Bx3xHxW
@@ -9,6 +9,7 @@ from torch import nn
 import torch.nn.functional as F
 import torch
 import torch.nn.utils.spectral_norm as spectral_norm
+from torch.nn.utils.spectral_norm import SpectralNormLoadStateDictPreHook
 import math
 import warnings
 
@@ -16,43 +17,62 @@ import warnings
 def kp2gaussian(kp, spatial_size, kp_variance):
     """
     Transform a keypoint into gaussian like representation
+    The isotropic gaussian is separable, so it is evaluated as the outer product of three 1-D gaussians
+    (d+h+w exponentials per keypoint instead of d*h*w)
+    kp: (..., 3), in x, y, z order; return: (..., d, h, w)
     """
-    mean = kp
+    z, y, x = make_coordinate_axes(spatial_size, kp)
 
-    coordinate_grid = make_coordinate_grid(spatial_size, mean)
-    number_of_leading_dimensions = len(mean.shape) - 1
-    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
-    coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
+    gx = torch.exp(-0.5 * (x - kp[..., 0:1]) ** 2 / kp_variance)  # (..., w)
+    gy = torch.exp(-0.5 * (y - kp[..., 1:2]) ** 2 / kp_variance)  # (..., h)
+    gz = torch.exp(-0.5 * (z - kp[..., 2:3]) ** 2 / kp_variance)  # (..., d)
 
-    # Preprocess kp shape
-    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
-    mean = mean.view(*shape)
+    out = gz[..., :, None, None] * gy[..., None, :, None] * gx[..., None, None, :]
 
-    mean_sub = (coordinate_grid - mean)
+    return out
 
-    out = torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
 
-    return out
+_coordinate_cache = {}
 
 
-def make_coordinate_grid(spatial_size, ref, **kwargs):
+def make_coordinate_axes(spatial_size, ref):
+    """
+    The normalized 1-D coordinates along d, h and w, cached per (shape, device, dtype)
+    """
     d, h, w = spatial_size
-    x = torch.arange(w).type(ref.dtype).to(ref.device)
-    y = torch.arange(h).type(ref.dtype).to(ref.device)
-    z = torch.arange(d).type(ref.dtype).to(ref.device)
+    key = ('axes', (d, h, w), ref.device, ref.dtype)
+    axes = _coordinate_cache.get(key)
+    if axes is None:
+        x = torch.arange(w).type(ref.dtype).to(ref.device)
+        y = torch.arange(h).type(ref.dtype).to(ref.device)
+        z = torch.arange(d).type(ref.dtype).to(ref.device)
+
+        # NOTE: must be right-down-in
+        x = (2 * (x / (w - 1)) - 1)  # the x axis faces to the right
+        y = (2 * (y / (h - 1)) - 1)  # the y axis faces to the bottom
+        z = (2 * (z / (d - 1)) - 1)  # the z axis faces to the inner
 
-    # NOTE: must be right-down-in
-    x = (2 * (x / (w - 1)) - 1)  # the x axis faces to the right
-    y = (2 * (y / (h - 1)) - 1)  # the y axis faces to the bottom
-    z = (2 * (z / (d - 1)) - 1)  # the z axis faces to the inner
+        axes = (z, y, x)
+        _coordinate_cache[key] = axes
+    return axes
+
+
+def make_coordinate_grid(spatial_size, ref, **kwargs):
+    """
+    The (d, h, w, 3) identity grid, cached per (shape, device, dtype), do not modify it in place
+    """
+    d, h, w = spatial_size
+    key = ('grid', (d, h, w), ref.device, ref.dtype)
+    meshed = _coordinate_cache.get(key)
+    if meshed is None:
+        z, y, x = make_coordinate_axes(spatial_size, ref)
 
-    yy = y.view(1, -1, 1).repeat(d, 1, w)
-    xx = x.view(1, 1, -1).repeat(d, h, 1)
-    zz = z.view(-1, 1, 1).repeat(1, h, w)
+        yy = y.view(1, -1, 1).repeat(d, 1, w)
+        xx = x.view(1, 1, -1).repeat(d, h, 1)
+        zz = z.view(-1, 1, 1).repeat(1, h, w)
 
-    meshed = torch.cat([xx.unsqueeze_(3), yy.unsqueeze_(3), zz.unsqueeze_(3)], 3)
+        meshed = torch.cat([xx.unsqueeze_(3), yy.unsqueeze_(3), zz.unsqueeze_(3)], 3)
+        _coordinate_cache[key] = meshed
 
     return meshed
 
@@ -264,10 +284,14 @@ class SPADE(nn.Module):
         self.mlp_gamma = nn.Conv2d(nhidden, norm_nc, kernel_size=3, padding=1)
         self.mlp_beta = nn.Conv2d(nhidden, norm_nc, kernel_size=3, padding=1)
 
-    def forward(self, x, segmap):
+    def forward(self, x, segmap, actv=None):
+        """
+        actv: the precomputed mlp_shared(segmap), see SPADEDecoder.fuse_spade
+        """
         normalized = self.param_free_norm(x)
-        segmap = F.interpolate(segmap, size=x.size()[2:], mode='nearest')
-        actv = self.mlp_shared(segmap)
+        if actv is None:
+            segmap = F.interpolate(segmap, size=x.size()[2:], mode='nearest')
+            actv = self.mlp_shared(segmap)
         gamma = self.mlp_gamma(actv)
         beta = self.mlp_beta(actv)
         out = normalized * (1 + gamma) + beta
@@ -298,16 +322,24 @@ class SPADEResnetBlock(nn.Module):
         if self.learned_shortcut:
             self.norm_s = SPADE(fin, label_nc)
 
-    def forward(self, x, seg1):
-        x_s = self.shortcut(x, seg1)
-        dx = self.conv_0(self.actvn(self.norm_0(x, seg1)))
-        dx = self.conv_1(self.actvn(self.norm_1(dx, seg1)))
+    def forward(self, x, seg1, actvs=None):
+        """
+        actvs: optional dict of the precomputed SPADE activations, keyed by 'norm_0', 'norm_1' and 'norm_s'
+        """
+        actvs = actvs or {}
+        x_s = self.shortcut(x, seg1, actvs.get('norm_s'))
+        dx = self.conv_0(self.actvn(self.norm_0(x, seg1, actvs.get('norm_0'))))
+        dx = self.conv_1(self.actvn(self.norm_1(dx, seg1, actvs.get('norm_1'))))
         out = x_s + dx
         return out
 
-    def shortcut(self, x, seg1):
+    def spade_layers(self):
+        names = ['norm_0', 'norm_1'] + (['norm_s'] if self.learned_shortcut else [])
+        return [(name, getattr(self, name)) for name in names]
+
+    def shortcut(self, x, seg1, actv=None):
         if self.learned_shortcut:
-            x_s = self.conv_s(self.norm_s(x, seg1))
+            x_s = self.conv_s(self.norm_s(x, seg1, actv))
         else:
             x_s = x
         return x_s
@@ -316,6 +348,51 @@ class SPADEResnetBlock(nn.Module):
         return F.leaky_relu(x, 2e-1)
 
 
+@torch.no_grad()
+def fold_batch_norm(conv, norm):
+    """
+    Fold an eval-mode BatchNorm that directly follows conv into the conv weights, in place
+    conv(x) -> norm(conv(x)); the folding is done in float64 and cast back
+    """
+    scale = norm.weight.double() / torch.sqrt(norm.running_var.double() + norm.eps)  # (out,)
+    bias = conv.bias.double() if conv.bias is not None else torch.zeros_like(scale)
+    weight = conv.weight.double() * scale.view(-1, *([1] * (conv.weight.dim() - 1)))
+    conv.weight.copy_(weight.to(conv.weight.dtype))
+    conv.bias = nn.Parameter(((bias - norm.running_mean.double()) * scale + norm.bias.double()).to(conv.weight.dtype), requires_grad=conv.weight.requires_grad)
+    return conv
+
+
+# blocks whose `norm` is a BatchNorm applied right after `conv`, before the activation
+FOLDABLE_NORM_BLOCKS = (SameBlock2d, DownBlock2d, DownBlock3d, UpBlock3d, Decoder)
+
+
+def freeze_for_inference(model):
+    """
+    One-time inference-only rewrite of model, in place:
+    the spectral_norm of the SPADEResnetBlock convs is baked into plain weights, and the BatchNorm of the
+    FOLDABLE_NORM_BLOCKS is folded into the preceding conv and replaced by an identity.
+    The result only matches the original in eval mode; the state_dict keys change accordingly
+    (no weight_orig/weight_u/weight_v, no norm.*), so a frozen checkpoint is loaded into a frozen model.
+    Calling it again on a frozen model is a no-op.
+    """
+    model.eval()
+    for module in model.modules():
+        if isinstance(module, SPADEResnetBlock):
+            for name in ('conv_0', 'conv_1', 'conv_s'):
+                conv = getattr(module, name, None)
+                if conv is not None and hasattr(conv, 'weight_orig'):
+                    # eval mode: the weight is weight_orig / sigma with the stored u, v, without power iteration
+                    nn.utils.remove_spectral_norm(conv)
+                    # remove_spectral_norm misses its load_state_dict pre-hook once torch has wrapped it
+                    for k, hook in list(conv._load_state_dict_pre_hooks.items()):
+                        if isinstance(getattr(hook, 'hook', hook), SpectralNormLoadStateDictPreHook):
+                            del conv._load_state_dict_pre_hooks[k]
+        elif isinstance(module, FOLDABLE_NORM_BLOCKS) and isinstance(module.norm, nn.modules.batchnorm._BatchNorm):
+            fold_batch_norm(module.conv, module.norm)
+            module.norm = nn.Identity()
+    return model
+
+
 def filter_state_dict(state_dict, remove_name='fc'):
     new_state_dict = {}
     for key in state_dict:
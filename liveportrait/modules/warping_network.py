@@ -8,7 +8,7 @@ keypoint representations x_s and x_d, and employs this flow field to warp the so
 from torch import nn
 import torch.nn.functional as F
 from .util import SameBlock2d
-from .dense_motion import DenseMotionNetwork
+from .dense_motion import DenseMotionNetwork, broadcast_source
 
 
 class WarpingNetwork(nn.Module):
@@ -46,11 +46,24 @@ class WarpingNetwork(nn.Module):
     def deform_input(self, inp, deformation):
         return F.grid_sample(inp, deformation, align_corners=False)
 
-    def forward(self, feature_3d, kp_driving, kp_source):
+    def prepare_source(self, feature_3d, kp_source):
+        """
+        Precompute everything that only depends on the source (f_s, x_s), so that the per-frame warp
+        skips the compress conv, the source heatmap and the identity grid
+        feature_3d: Nx32x16x64x64; kp_source: NxKx3
+        """
+        prepared_source = self.dense_motion_network.prepare_source(feature_3d, kp_source)
+        prepared_source['feature_3d'] = feature_3d
+        return prepared_source
+
+    def forward(self, feature_3d, kp_driving, kp_source, prepared_source=None):
+        if prepared_source is not None:
+            feature_3d = broadcast_source(prepared_source['feature_3d'], kp_driving.shape[0])
+
         if self.dense_motion_network is not None:
             # Feature warper, Transforming feature representation according to deformation and occlusion
             dense_motion = self.dense_motion_network(
-                feature=feature_3d, kp_driving=kp_driving, kp_source=kp_source
+                feature=feature_3d, kp_driving=kp_driving, kp_source=kp_source, prepared_source=prepared_source
             )
             if 'occlusion_map' in dense_motion:
                 occlusion_map = dense_motion['occlusion_map']  # Bx1x64x64
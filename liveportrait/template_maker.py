@@ -7,7 +7,7 @@ Make video template
 import os
 import cv2
 import numpy as np
-import pickle
+import torch
 from rich.progress import track
 from .utils.cropper import Cropper
 
@@ -15,6 +15,7 @@ from .utils.io import load_driving_info
 from .utils.camera import get_rotation_matrix
 from .utils.helper import mkdir, basename
 from .utils.rprint import rlog as log
+from .utils.motion_track import MotionTrack
 from .config.crop_config import CropConfig
 from .config.inference_config import InferenceConfig
 from .live_portrait_wrapper import LivePortraitWrapper
@@ -23,43 +24,49 @@ class TemplateMaker:
 
     def __init__(self, inference_cfg: InferenceConfig, crop_cfg: CropConfig):
         self.live_portrait_wrapper: LivePortraitWrapper = LivePortraitWrapper(cfg=inference_cfg)
-        self.cropper = Cropper(crop_cfg=crop_cfg)
+        self.cropper = Cropper()
+        self.crop_cfg = crop_cfg
 
     def make_motion_template(self, video_fp: str, output_path: str, **kwargs):
-        """ make video template (.pkl format)
+        """ make video template (.npz MotionTrack, see utils.motion_track)
         video_fp: driving video file path
-        output_path: where to save the pickle file
+        output_path: where to save the template
+        fps: the frame rate stored in the template, 0 if unknown
         """
 
         driving_rgb_lst = load_driving_info(video_fp)
         driving_rgb_lst = [cv2.resize(_, (256, 256)) for _ in driving_rgb_lst]
         driving_lmk_lst = self.cropper.get_retargeting_lmk_info(driving_rgb_lst)
-        I_d_lst = self.live_portrait_wrapper.prepare_driving_videos(driving_rgb_lst)
+        n_frames = len(driving_rgb_lst)
+        batch_size = kwargs.get('batch_size', 32)
 
-        n_frames = I_d_lst.shape[0]
+        x_d_info_lst, R_d_lst = [], []
+        for i in track(range(0, n_frames, batch_size), description='Making templates...'):
+            I_d = self.live_portrait_wrapper.prepare_driving_videos(driving_rgb_lst[i:i + batch_size]).flatten(0, 1)  # Bx3xHxW
+            x_d_info = self.live_portrait_wrapper.get_kp_info(I_d)
+            x_d_info_lst.append(x_d_info)
+            R_d_lst.append(get_rotation_matrix(x_d_info['pitch'], x_d_info['yaw'], x_d_info['roll']))
 
-        templates = []
+        input_eye_ratio_lst, input_lip_ratio_lst = self.live_portrait_wrapper.calc_retargeting_ratio(None, driving_lmk_lst)
+        motion_track = MotionTrack.from_driving({
+            'x_d_info': {k: torch.cat([_[k] for _ in x_d_info_lst], dim=0) for k in x_d_info_lst[0].keys()},
+            'R_d': torch.cat(R_d_lst, dim=0),
+            'input_eye_ratio': np.concatenate(input_eye_ratio_lst, axis=0)[:, :1],
+            'input_lip_ratio': np.concatenate(input_lip_ratio_lst, axis=0),
+        }, fps=kwargs.get('fps', 0.))
 
+        mkdir(output_path)
+        template_fp = motion_track.save(os.path.join(output_path, f'{basename(video_fp)}.npz'))
+        log(f"Template saved at {template_fp}")
+        return template_fp
 
-        for i in track(range(n_frames), description='Making templates...', total=n_frames):
-            I_d_i = I_d_lst[i]
-            x_d_i_info = self.live_portrait_wrapper.get_kp_info(I_d_i)
-            R_d_i = get_rotation_matrix(x_d_i_info['pitch'], x_d_i_info['yaw'], x_d_i_info['roll'])
-            # collect s_d, R_d, δ_d and t_d for inference
-            template_dct = {
-                'n_frames': n_frames,
-                'frames_index': i,
-            }
-            template_dct['scale'] = x_d_i_info['scale'].cpu().numpy().astype(np.float32)
-            template_dct['R_d'] = R_d_i.cpu().numpy().astype(np.float32)
-            template_dct['exp'] = x_d_i_info['exp'].cpu().numpy().astype(np.float32)
-            template_dct['t'] = x_d_i_info['t'].cpu().numpy().astype(np.float32)
-
-            templates.append(template_dct)
-
+    @staticmethod
+    def convert_template(template_fp: str, output_path: str = None):
+        """ one-off conversion of a legacy .pkl template to a .npz MotionTrack, next to it unless output_path is given
+        the .pkl is unpickled, which can run arbitrary code: only convert templates of a trusted source
+        """
+        output_path = output_path or os.path.dirname(template_fp) or '.'
         mkdir(output_path)
-        # Save the dictionary as a pickle file
-        pickle_fp = os.path.join(output_path, f'{basename(video_fp)}.pkl')
-        with open(pickle_fp, 'wb') as f:
-            pickle.dump([templates, driving_lmk_lst], f)
-        log(f"Template saved at {pickle_fp}")
+        template_fp = MotionTrack.from_template(template_fp).save(os.path.join(output_path, f'{basename(template_fp)}.npz'))
+        log(f"Template converted to {template_fp}")
+        return template_fp
@@ -10,6 +10,16 @@ import torch.nn.functional as F
 
 PI = np.pi
 
+_idx_tensor_cache = {}
+
+
+def _get_idx_tensor(device):
+    idx_tensor = _idx_tensor_cache.get(device)
+    if idx_tensor is None:
+        idx_tensor = torch.arange(66, dtype=torch.float32, device=device)
+        _idx_tensor_cache[device] = idx_tensor
+    return idx_tensor
+
 
 def headpose_pred_to_degree(pred):
     """
@@ -17,9 +27,7 @@ def headpose_pred_to_degree(pred):
     """
     if pred.ndim > 1 and pred.shape[1] == 66:
         # NOTE: note that the average is modified to 97.5
-        device = pred.device
-        idx_tensor = [idx for idx in range(0, 66)]
-        idx_tensor = torch.FloatTensor(idx_tensor).to(device)
+        idx_tensor = _get_idx_tensor(pred.device)
         pred = F.softmax(pred, dim=1)
         degree = torch.sum(pred*idx_tensor, axis=1) * 3 - 97.5
 
@@ -73,3 +81,30 @@ def get_rotation_matrix(pitch_, yaw_, roll_):
 
     rot = rot_z @ rot_y @ rot_x
     return rot.permute(0, 2, 1)  # transpose
+
+
+def compose_driving_keypoints(x_s_info, R_s, x_d_info, R_d, flag_relative=True, x_d_0_info=None, R_d_0=None):
+    """ Eqn. 7 for a whole clip at once: the driving keypoints before stitching and retargeting
+    x_s_info: kp info of the source, batch 1; R_s: 1x3x3
+    x_d_info: kp info of the driving frames stacked over T; R_d: Tx3x3
+    x_d_0_info, R_d_0: the anchor frame of the relative motion, the first driving frame by default
+    return: Txnum_kpx3
+    """
+    if x_d_0_info is None:
+        x_d_0_info = {k: v[0:1] for k, v in x_d_info.items()}
+    if R_d_0 is None:
+        R_d_0 = R_d[0:1]
+
+    if flag_relative:
+        R_new = (R_d @ R_d_0.permute(0, 2, 1)) @ R_s
+        delta_new = x_s_info['exp'] + (x_d_info['exp'] - x_d_0_info['exp'])
+        scale_new = x_s_info['scale'] * (x_d_info['scale'] / x_d_0_info['scale'])
+        t_new = x_s_info['t'] + (x_d_info['t'] - x_d_0_info['t'])
+    else:
+        R_new = R_d
+        delta_new = x_d_info['exp']
+        scale_new = x_s_info['scale']
+        t_new = x_d_info['t'].clone()
+
+    t_new[..., 2].fill_(0)  # zero tz
+    return scale_new[..., None] * (x_s_info['kp'] @ R_new + delta_new) + t_new[:, None, :]
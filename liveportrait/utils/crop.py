@@ -349,12 +349,14 @@ def _estimate_similar_transform_from_pts(
 def crop_image(img, pts: np.ndarray, **kwargs):
     dsize = kwargs.get('dsize', 224)
     scale = kwargs.get('scale', 1.5)  # 1.5 | 1.6
+    vx_ratio = kwargs.get('vx_ratio', 0)
     vy_ratio = kwargs.get('vy_ratio', -0.1)  # -0.0625 | -0.1
 
     M_INV, _ = _estimate_similar_transform_from_pts(
         pts,
         dsize=dsize,
         scale=scale,
+        vx_ratio=vx_ratio,
         vy_ratio=vy_ratio,
         flag_do_rot=kwargs.get('flag_do_rot', True),
     )
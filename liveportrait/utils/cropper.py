@@ -6,8 +6,7 @@ from typing import List, Union, Tuple
 from dataclasses import dataclass, field
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
 
-from .landmark_runner import LandmarkRunner
-from .face_analysis_diy import FaceAnalysisDIY
+from .session_pool import get_landmark_runner, get_face_analysis, default_onnx_provider, onnx_execution_providers
 #from .helper import prefix
 from .crop import crop_image, crop_image_by_bbox, parse_bbox_from_landmark, average_bbox_lst
 #from .timer import Timer
@@ -34,30 +33,42 @@ class Trajectory:
 
 
 class Cropper(object):
+    """ face detection, alignment and cropping
+
+    The onnxruntime and InsightFace sessions come from the process-wide session pool, so
+    constructing a Cropper is cheap. Crop settings (dsize, scale, vx_ratio, vy_ratio) are
+    passed per call to crop_single_image.
+    onnx_provider: 'cuda' or 'cpu', defaults to cuda when onnxruntime has it
+    num_threads: onnxruntime intra-op threads of the landmark runner on cpu
+    """
     def __init__(self, **kwargs) -> None:
         device_id = kwargs.get('device_id', 0)
-        self.landmark_runner = LandmarkRunner(
+        onnx_provider = kwargs.get('onnx_provider') or default_onnx_provider()
+        self.landmark_ckpt_path = os.path.join(folder_paths.models_dir, 'liveportrait', 'landmark.onnx')
+        self.face_analysis_root = os.path.join(folder_paths.models_dir, 'insightface')
+        self.landmark_runner = get_landmark_runner(
             #ckpt_path=make_abs_path('../../pretrained_weights/liveportrait/landmark.onnx'),
-            ckpt_path=os.path.join(folder_paths.models_dir, 'liveportrait', 'landmark.onnx'),
-            onnx_provider='cuda',
-            device_id=device_id
+            ckpt_path=self.landmark_ckpt_path,
+            onnx_provider=onnx_provider,
+            device_id=device_id,
+            num_threads=kwargs.get('num_threads', 4)
         )
-        self.landmark_runner.warmup()
 
-        self.face_analysis_wrapper = FaceAnalysisDIY(
+        self.face_analysis_wrapper = get_face_analysis(
             name='buffalo_l',
-            root=os.path.join(folder_paths.models_dir, 'insightface'),
-            providers=["CUDAExecutionProvider"]
+            root=self.face_analysis_root,
+            providers=onnx_execution_providers(onnx_provider),
+            device_id=device_id,
+            det_size=(512, 512)
         )
-        self.face_analysis_wrapper.prepare(ctx_id=device_id, det_size=(512, 512))
-        self.face_analysis_wrapper.warmup()
 
-        self.crop_cfg = kwargs.get('crop_cfg', None)
-
-    def update_config(self, user_args):
-        for k, v in user_args.items():
-            if hasattr(self.crop_cfg, k):
-                setattr(self.crop_cfg, k, v)
+    def model_fingerprint(self) -> str:
+        """ path, size and mtime of the landmark and face analysis models, what the landmarks depend on besides the image """
+        paths = [self.landmark_ckpt_path]
+        for model_dir in (osp.join(self.face_analysis_root, 'models', 'buffalo_l'), osp.join(self.face_analysis_root, 'buffalo_l')):
+            if osp.isdir(model_dir):
+                paths += sorted(osp.join(model_dir, f) for f in os.listdir(model_dir) if f.endswith('.onnx'))
+        return ';'.join(f'{p}:{osp.getsize(p)}:{osp.getmtime(p)}' if osp.exists(p) else f'{p}:missing' for p in paths)
 
     def crop_single_image(self, obj, **kwargs):
         direction = kwargs.get('direction', 'large-small')
@@ -89,6 +100,7 @@ class Cropper(object):
             pts,  # 106x2 or Nx2
             dsize=kwargs.get('dsize', 512),
             scale=kwargs.get('scale', 2.3),
+            vx_ratio=kwargs.get('vx_ratio', 0),
             vy_ratio=kwargs.get('vy_ratio', -0.15),
         )
         # update a 256x256 version for network input or else
@@ -133,7 +145,7 @@ class Cropper(object):
                 trajectory.end = idx
 
             trajectory.lmk_lst.append(lmk_203)
-            ret_bbox = parse_bbox_from_landmark(lmk_203, scale=self.crop_cfg.globalscale, vy_ratio=elf.crop_cfg.vy_ratio)['bbox']
+            ret_bbox = parse_bbox_from_landmark(lmk_203, scale=kwargs.get('scale', 2.3), vy_ratio=kwargs.get('vy_ratio', -0.125))['bbox']
             bbox = [ret_bbox[0, 0], ret_bbox[0, 1], ret_bbox[2, 0], ret_bbox[2, 1]]  # 4,
             trajectory.bbox_lst.append(bbox)  # bbox
             trajectory.frame_rgb_lst.append(driving_image)
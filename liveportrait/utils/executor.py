@@ -0,0 +1,175 @@
+# coding: utf-8
+
+"""
+pipelined executor: a chain of stages, each in its own thread, connected by bounded queues,
+so that successive items are in different stages at the same time
+"""
+
+import queue
+import threading
+import time
+
+from .rprint import rlog as log
+
+_END = object()  # end of the stream
+
+
+class _Failure(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.  # seconds spent inside the stage function
+        self.items = 0
+
+    def utilization(self, wall):
+        return self.busy / wall if wall > 0 else 0.
+
+
+class PipelinedExecutor(object):
+    """ runs items through stages [(name, fn), ...], fn(item) -> item for the next stage
+
+    Every stage runs in its own thread and processes the items in order; the queue between two stages holds
+    at most queue_depth items, which bounds the memory in flight. The throughput approaches the one of the
+    slowest stage instead of the sum of all stages, as long as the stages release the GIL (torch, cv2, numpy).
+    queue_depth 0 runs the stages one after the other in the calling thread.
+    After a run, stats holds the per-stage busy time and utilization (busy time / wall time).
+    """
+
+    def __init__(self, stages, queue_depth=2, name='pipeline'):
+        self.stages = list(stages)
+        self.queue_depth = max(int(queue_depth), 0)
+        self.name = name
+        self.stats = {}
+        self.wall = 0.
+
+    def run(self, items):
+        """ generator of the results of the last stage, in the order of items
+        items: any iterable, pulled lazily by a feeder thread; closed once the run ends, however it ends, so that
+        a generator releases its resources (e.g. the decoder thread of a DrivingVideo) right away
+        """
+        self.stats = {name: StageStats(name) for name, _ in self.stages}
+        start = time.perf_counter()
+        try:
+            if self.queue_depth == 0:
+                yield from self._run_sequential(items)
+            else:
+                yield from self._run_threaded(items)
+        finally:
+            self.wall = time.perf_counter() - start
+
+    def _call(self, name, fn, item):
+        t = time.perf_counter()
+        item = fn(item)
+        stats = self.stats[name]
+        stats.busy += time.perf_counter() - t
+        stats.items += 1
+        return item
+
+    @staticmethod
+    def _close(items):
+        close = getattr(items, 'close', None)
+        if close is not None:
+            close()
+
+    def _run_sequential(self, items):
+        try:
+            for item in items:
+                for name, fn in self.stages:
+                    item = self._call(name, fn, item)
+                yield item
+        finally:
+            self._close(items)
+
+    def _run_threaded(self, items):
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_depth) for _ in range(len(self.stages) + 1)]
+
+        def put(q, item):
+            # gives up once the consumer has stopped, so that no thread stays blocked on a full queue
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _END
+
+        def feeder():
+            try:
+                for item in items:
+                    if not put(queues[0], item):
+                        return
+                put(queues[0], _END)
+            except Exception as e:
+                put(queues[0], _Failure(e))
+            finally:
+                try:
+                    self._close(items)  # in the thread that iterated items
+                except Exception as e:
+                    log(f'{self.name}: closing the items failed: {e}')
+
+        def worker(name, fn, q_in, q_out):
+            while True:
+                item = get(q_in)
+                if item is _END or isinstance(item, _Failure):
+                    put(q_out, item)
+                    return
+                try:
+                    item = self._call(name, fn, item)
+                except Exception as e:
+                    put(q_out, _Failure(e))
+                    return
+                if not put(q_out, item):
+                    return
+
+        finished = set()  # the threads that returned, the others that are not alive died outside of the error handling
+
+        def guarded(target, *args):
+            target(*args)
+            finished.add(threading.current_thread().name)
+
+        threads = [threading.Thread(target=guarded, args=(feeder,), name=f'{self.name}-feeder', daemon=True)]
+        for i, (name, fn) in enumerate(self.stages):
+            threads.append(threading.Thread(target=guarded, args=(worker, name, fn, queues[i], queues[i + 1]), name=f'{self.name}-{name}', daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                try:
+                    item = queues[-1].get(timeout=0.1)
+                except queue.Empty:
+                    dead = [thread.name for thread in threads if not thread.is_alive() and thread.name not in finished]
+                    if dead:
+                        raise RuntimeError(f'{self.name}: {", ".join(dead)} exited without finishing the run')
+                    continue
+                if item is _END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def report(self):
+        """ log the utilization of every stage of the last run
+        """
+        if self.wall <= 0:
+            return
+        busiest = max(self.stats.values(), key=lambda s: s.busy, default=None)
+        parts = [f'{s.name} {s.utilization(self.wall) * 100:.0f}%' for s in self.stats.values()]
+        log(f'{self.name}: {self.wall:.2f}s, stage utilization: ' + ', '.join(parts) + (f', bottleneck: {busiest.name}' if busiest is not None else ''))
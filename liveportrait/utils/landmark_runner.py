@@ -29,6 +29,7 @@ class LandmarkRunner(object):
         ckpt_path = kwargs.get('ckpt_path')
         onnx_provider = kwargs.get('onnx_provider', 'cuda')  # 默认用cuda
         device_id = kwargs.get('device_id', 0)
+        num_threads = kwargs.get('num_threads', 4)
         self.dsize = kwargs.get('dsize', 224)
         self.timer = Timer()
 
@@ -40,7 +41,7 @@ class LandmarkRunner(object):
             )
         else:
             opts = onnxruntime.SessionOptions()
-            opts.intra_op_num_threads = 4  # 默认线程数为 4
+            opts.intra_op_num_threads = num_threads  # 默认线程数为 4
             self.session = onnxruntime.InferenceSession(
                 ckpt_path, providers=['CPUExecutionProvider'],
                 sess_options=opts
@@ -0,0 +1,165 @@
+# coding: utf-8
+
+"""
+content-addressed cache of the driving motion: the output of M and of the retargeting ratios for a whole driving clip,
+keyed by a hash of the driving frames and of the motion extractor, in memory and on disk
+"""
+
+import hashlib
+import os
+import os.path as osp
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .rprint import rlog as log
+
+HASH_CHUNK_FRAMES = 64  # frames hashed at a time, so that a clip on the device is not copied to the host at once
+
+
+def _hasher():
+    return hashlib.blake2b(digest_size=20)
+
+
+def hash_frames(frames) -> str:
+    """ content hash of driving frames: a TxHxWx3 array or tensor, or anything with a content_key() (DrivingVideo)
+    """
+    if hasattr(frames, 'content_key'):
+        return frames.content_key()
+    h = _hasher()
+    h.update(f'{type(frames).__name__}:{tuple(frames.shape)}:{frames.dtype}'.encode())
+    for i in range(0, len(frames), HASH_CHUNK_FRAMES):
+        chunk = frames[i:i + HASH_CHUNK_FRAMES]
+        if isinstance(chunk, torch.Tensor):
+            chunk = chunk.detach().cpu().contiguous().numpy()
+        h.update(np.ascontiguousarray(chunk).data)
+    return h.hexdigest()
+
+
+def module_fingerprint(module: torch.nn.Module) -> str:
+    """ hash of the weights of a module, its version as far as the cache is concerned """
+    h = _hasher()
+    for name, t in list(module.state_dict().items()):
+        h.update(name.encode())
+        h.update(t.detach().cpu().contiguous().view(torch.uint8).numpy().data if t.numel() else b'')
+    return h.hexdigest()
+
+
+class MotionCache(object):
+    """ driving motion dicts (see LivePortraitPipeline.concat_driving) by key, in an LRU of max_items in memory,
+    backed by one .npz per key in cache_dir when it is set
+
+    The entries are kept on the cpu and moved to the device of the caller by get().
+    The files in cache_dir are kept under max_disk_mb (0 for unlimited): the least recently used ones, by mtime,
+    which a hit refreshes, are deleted after every write.
+    """
+
+    def __init__(self, cache_dir=None, max_items=32, max_disk_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_disk_bytes = int(max_disk_mb * 1024 ** 2)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return osp.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key, device='cpu'):
+        """ the motion dict stored for key on device, None on a miss """
+        with self._lock:
+            driving = self._entries.get(key)
+            if driving is not None:
+                self._entries.move_to_end(key)
+        if driving is None and self.cache_dir is not None and osp.exists(self._path(key)):
+            try:
+                driving = self._load(self._path(key))
+                os.utime(self._path(key))  # most recently used
+            except (OSError, ValueError, KeyError) as e:
+                log(f'Could not read the cached motion {self._path(key)}: {e}')
+                return None
+            self._remember(key, driving)
+        if driving is None:
+            return None
+        return {
+            'n_frames': driving['n_frames'],
+            'x_d_info': {k: v.to(device) for k, v in driving['x_d_info'].items()},
+            'R_d': driving['R_d'].to(device),
+            'input_eye_ratio': driving['input_eye_ratio'],
+            'input_lip_ratio': driving['input_lip_ratio'],
+        }
+
+    def put(self, key, driving):
+        driving = {
+            'n_frames': driving['n_frames'],
+            'x_d_info': {k: v.detach().cpu() for k, v in driving['x_d_info'].items()},
+            'R_d': driving['R_d'].detach().cpu(),
+            'input_eye_ratio': driving['input_eye_ratio'],
+            'input_lip_ratio': driving['input_lip_ratio'],
+        }
+        self._remember(key, driving)
+        if self.cache_dir is not None:
+            try:
+                self._save(self._path(key), driving)
+                self.trim_disk()
+            except OSError as e:
+                log(f'Could not write the cached motion {self._path(key)}: {e}')
+
+    def _remember(self, key, driving):
+        with self._lock:
+            self._entries[key] = driving
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def trim_disk(self):
+        """ delete the least recently used files of cache_dir until they fit in max_disk_bytes """
+        if self.cache_dir is None or self.max_disk_bytes <= 0 or not osp.isdir(self.cache_dir):
+            return
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                path = osp.join(self.cache_dir, name)
+                try:
+                    files.append((osp.getmtime(path), osp.getsize(path), path))
+                except OSError:
+                    continue  # removed meanwhile
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):  # oldest first
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    @staticmethod
+    def _save(path, driving):
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        arrays = {f'x_d_info.{k}': v.numpy() for k, v in driving['x_d_info'].items()}
+        arrays['R_d'] = driving['R_d'].numpy()
+        for k in ('input_eye_ratio', 'input_lip_ratio'):
+            if driving[k] is not None:
+                arrays[k] = driving[k]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)  # readers never see a partial file
+
+    @staticmethod
+    def _load(path):
+        with np.load(path) as data:
+            R_d = torch.from_numpy(data['R_d'])
+            return {
+                'n_frames': R_d.shape[0],
+                'x_d_info': {k[len('x_d_info.'):]: torch.from_numpy(data[k]) for k in data.files if k.startswith('x_d_info.')},
+                'R_d': R_d,
+                'input_eye_ratio': data['input_eye_ratio'] if 'input_eye_ratio' in data.files else None,
+                'input_lip_ratio': data['input_lip_ratio'] if 'input_lip_ratio' in data.files else None,
+            }
@@ -0,0 +1,158 @@
+# coding: utf-8
+
+"""
+MotionTrack: the motion of a driving clip as contiguous per-quantity arrays, saved as an uncompressed .npz that is
+memory-mapped on load
+"""
+
+import os
+import os.path as osp
+import pickle
+import struct
+import zipfile
+
+import numpy as np
+import torch
+
+from .retargeting_utils import calc_eye_close_ratio, calc_lip_close_ratio
+
+# the keys of the motion dicts of LivePortraitPipeline.prepare_driving_chunk, by array name
+KP_INFO_FIELDS = ('pitch', 'yaw', 'roll', 't', 'exp', 'scale', 'kp')  # x_d_info
+RATIO_FIELDS = {'eye_ratio': 'input_eye_ratio', 'lip_ratio': 'input_lip_ratio'}
+
+
+def _mmap_npz(path):
+    """ the arrays of an uncompressed .npz as read-only memory maps, None if a member is compressed
+    every member of the zip is a .npy file stored as is, so it can be mapped at its offset in the file
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                return None
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])  # local file header
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError(f'{path}: {info.filename} holds python objects, not a MotionTrack array')
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C', offset=f.tell())
+    return arrays
+
+
+class MotionTrack(object):
+    """ the motion of a driving clip, everything the renderer needs from the driving frames, so that they are not needed
+
+    One contiguous float32 array per quantity, frames first (structure of arrays):
+        pitch, yaw, roll: Tx1, degrees; t: Tx3; exp, kp: TxNx3; scale: Tx1; R: Tx3x3, the rotation of pitch/yaw/roll
+        eye_ratio, lip_ratio: Tx1, for the eye and lip retargeting, absent if not extracted
+    pitch, yaw, roll and kp are absent in tracks converted from legacy .pkl templates, the renderer does not need them.
+    fps: the frame rate of the driving clip, 0 if unknown
+
+    save() writes an uncompressed .npz, load() maps it into memory, so loading costs the same for any length
+    and a slice only reads the frames it covers.
+    """
+
+    def __init__(self, arrays: dict, fps=0.):
+        self.arrays = dict(arrays)
+        self.fps = float(fps)
+        lengths = {len(v) for v in self.arrays.values()}
+        if len(lengths) != 1:
+            raise ValueError(f'MotionTrack arrays have different lengths: { {k: len(v) for k, v in self.arrays.items()} }')
+        self.n_frames = lengths.pop()
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, index):
+        """ a slice of frames, views into the same arrays """
+        if not isinstance(index, slice):
+            raise TypeError('MotionTrack only supports slicing')
+        return MotionTrack({k: v[index] for k, v in self.arrays.items()}, fps=self.fps / (index.step or 1))
+
+    @property
+    def has_ratios(self):
+        return all(k in self.arrays for k in RATIO_FIELDS)
+
+    def nbytes(self):
+        return sum(v.nbytes for v in self.arrays.values())
+
+    @classmethod
+    def from_driving(cls, driving, fps=0.):
+        """ driving: a motion dict of LivePortraitPipeline.prepare_driving_chunk or concat_driving """
+        arrays = {k: v.detach().float().cpu().numpy() for k, v in driving['x_d_info'].items() if k in KP_INFO_FIELDS}
+        arrays['R'] = driving['R_d'].detach().float().cpu().numpy()
+        for name, key in RATIO_FIELDS.items():
+            if driving.get(key) is not None:
+                arrays[name] = np.asarray(driving[key], dtype=np.float32)
+        return cls(arrays, fps=fps)
+
+    def to_driving(self, device='cpu', start=0, stop=None) -> dict:
+        """ the motion dict of the frames start..stop, as prepare_driving_chunk returns it, on device """
+        stop = self.n_frames if stop is None else min(stop, self.n_frames)
+
+        def _tensor(name):
+            return torch.from_numpy(np.array(self.arrays[name][start:stop], dtype=np.float32)).to(device)  # reads only the slice
+
+        return {
+            'n_frames': max(stop - start, 0),
+            'x_d_info': {k: _tensor(k) for k in KP_INFO_FIELDS if k in self.arrays},
+            'R_d': _tensor('R'),
+            'input_eye_ratio': np.array(self.arrays['eye_ratio'][start:stop]) if 'eye_ratio' in self.arrays else None,
+            'input_lip_ratio': np.array(self.arrays['lip_ratio'][start:stop]) if 'lip_ratio' in self.arrays else None,
+        }
+
+    def iter_driving(self, chunk_size, device='cpu'):
+        for start in range(0, self.n_frames, chunk_size):
+            yield self.to_driving(device, start, start + chunk_size)
+
+    def save(self, path):
+        """ an uncompressed .npz, written to a temporary file first """
+        if osp.dirname(path):
+            os.makedirs(osp.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, fps=np.float64(self.fps)[None], **{k: np.ascontiguousarray(v) for k, v in self.arrays.items()})
+        os.replace(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ a MotionTrack .npz, memory-mapped unless mmap is False or the file is compressed
+        never unpickles: a legacy .pkl template is converted once with from_template (TemplateMaker.convert_template)
+        """
+        if not path.endswith('.npz'):
+            raise ValueError(f'Not a MotionTrack .npz: {path}' + (', convert a .pkl template of a trusted source once with '
+                                                                   'TemplateMaker.convert_template' if path.endswith('.pkl') else ''))
+        arrays = _mmap_npz(path) if mmap else None
+        if arrays is None:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {k: data[k] for k in data.files}
+        fps = float(arrays.pop('fps')[0]) if 'fps' in arrays else 0.
+        return cls(arrays, fps=fps)
+
+    @classmethod
+    def from_template(cls, path):
+        """ a .pkl template of TemplateMaker before MotionTrack: [per-frame dicts of scale, R_d, exp, t], [landmarks]
+        this unpickles the file, which can run arbitrary code: only for templates of a trusted source
+        """
+        with open(path, 'rb') as f:
+            templates, driving_lmk_lst = pickle.load(f)
+        arrays = {
+            'scale': np.concatenate([_['scale'] for _ in templates], axis=0).astype(np.float32),
+            'R': np.concatenate([_['R_d'] for _ in templates], axis=0).astype(np.float32),
+            'exp': np.concatenate([_['exp'] for _ in templates], axis=0).astype(np.float32),
+            't': np.concatenate([_['t'] for _ in templates], axis=0).astype(np.float32),
+        }
+        if driving_lmk_lst is not None and len(driving_lmk_lst) == len(templates):
+            arrays['eye_ratio'] = np.concatenate([calc_eye_close_ratio(lmk[None]) for lmk in driving_lmk_lst], axis=0)[:, :1].astype(np.float32)
+            arrays['lip_ratio'] = np.concatenate([calc_lip_close_ratio(lmk[None]) for lmk in driving_lmk_lst], axis=0).astype(np.float32)
+        return cls(arrays)
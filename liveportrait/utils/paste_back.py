@@ -0,0 +1,262 @@
+# coding: utf-8
+
+"""
+paste-back of the animated crops into the original source image
+"""
+
+import copy
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def mask_roi(mask: np.ndarray):
+    """ mask: hxw, the region where mask > 0 as (slice y, slice x), None if it is empty
+    """
+    ys, xs = np.nonzero(mask)
+    if len(ys) == 0:
+        return None
+    return (slice(ys.min(), ys.max() + 1), slice(xs.min(), xs.max() + 1))
+
+
+class TorchPasteBack(object):
+    """ warps the animated crops back to the source image with grid_sample and blends them with the crop mask,
+    on the device of the generator and for a whole batch of frames at once
+
+    The sampling grid (the inverse of M_c2o for every source pixel), the warped mask and the source image
+    are built once per source, every frame then costs one grid_sample and one blend.
+    img_rgb: HxWx3, uint8, the source image
+    M_c2o: 3x3, crop -> source image, in pixels of the crop
+    mask_crop: hxwx3 or hxw, uint8, the mask in crop space, same size as the crops
+    """
+
+    def __init__(self, img_rgb: np.ndarray, M_c2o: np.ndarray, mask_crop: np.ndarray, device):
+        h, w = img_rgb.shape[:2]
+        crop_h, crop_w = mask_crop.shape[:2]
+        self.crop_size = (crop_h, crop_w)
+        self.device = torch.device(device)
+
+        # same sampling as cv2.warpAffine(crop, M_c2o): every source pixel looks up inv(M_c2o) @ (x, y, 1) in the crop
+        M = np.eye(3)
+        M[:2] = np.asarray(M_c2o, dtype=np.float64)[:2]
+        M_o2c = np.linalg.inv(M)
+        ys, xs = np.mgrid[0:h, 0:w].astype(np.float64)
+        u = M_o2c[0, 0] * xs + M_o2c[0, 1] * ys + M_o2c[0, 2]
+        v = M_o2c[1, 0] * xs + M_o2c[1, 1] * ys + M_o2c[1, 2]
+        # pixel centers -> [-1, 1] for align_corners=False
+        grid = np.stack([(2 * u + 1) / crop_w - 1, (2 * v + 1) / crop_h - 1], axis=-1)
+        self.grid = torch.from_numpy(grid.astype(np.float32))[None].to(self.device)  # 1xHxWx2
+
+        mask = mask_crop[..., 0] if mask_crop.ndim == 3 else mask_crop
+        mask = torch.from_numpy(mask.astype(np.float32) / 255.)[None, None].to(self.device)  # 1x1xhxw
+        self.mask = F.grid_sample(mask, self.grid, mode='bilinear', padding_mode='zeros', align_corners=False)  # 1x1xHxW
+        self.img = torch.from_numpy(img_rgb).to(self.device).permute(2, 0, 1)[None].float()  # 1x3xHxW, 0~255
+        self.roi = mask_roi((self.mask[0, 0] > 0).cpu().numpy())  # outside of it the source is kept as is
+
+    def __call__(self, I_p: torch.Tensor, dtype=torch.uint8, roi_only=False) -> torch.Tensor:
+        """ I_p: Bx3xhxw, 0~1, the output of G
+        roi_only: only the pixels of self.roi, Bxh_roixw_roix3
+        return: BxHxWx3, uint8 in 0~255, or float in 0~1 for a floating dtype
+        """
+        I_p = I_p.to(device=self.device, dtype=torch.float32).clamp(0, 1)
+        if tuple(I_p.shape[2:]) != self.crop_size:
+            I_p = F.interpolate(I_p, size=self.crop_size, mode='bilinear', align_corners=False)
+        bs = I_p.shape[0]
+        grid, img, mask = self.grid, self.img, self.mask
+        if roi_only:
+            if self.roi is None:
+                return torch.empty((bs, 0, 0, 3), dtype=dtype, device=self.device)
+            ys, xs = self.roi
+            grid, img, mask = grid[:, ys, xs], img[:, :, ys, xs], mask[:, :, ys, xs]
+        I_p_to_ori = F.grid_sample(I_p, grid.expand(bs, -1, -1, -1), mode='bilinear', padding_mode='zeros', align_corners=False)
+        out = torch.lerp(img, I_p_to_ori * 255., mask)  # mask * I_p_to_ori + (1 - mask) * img
+        out = out.permute(0, 2, 3, 1)
+        if dtype == torch.uint8:
+            return out.clamp(0, 255).to(torch.uint8)
+        return (out / 255.).clamp(0, 1).to(dtype)
+
+    def to(self, device):
+        """ a copy with its tensors on device, self if they already are """
+        device = torch.device(device)
+        if device == self.device:
+            return self
+        moved = copy.copy(self)
+        moved.device = device
+        moved.grid, moved.mask, moved.img = self.grid.to(device), self.mask.to(device), self.img.to(device)
+        return moved
+
+
+class RoiPasteBack(object):
+    """ cv2 paste-back restricted to the region the crop mask covers in the source image, for the cpu
+
+    Built once per source: the bounding box (ROI) of the warped mask, a cv2.remap table of inv(M_c2o) for the
+    pixels of that ROI, the mask as an 8-bit fixed-point alpha, and the (1 - alpha) * source term of the blend.
+    Every frame then remaps the crop into the ROI only, blends it with integer arithmetic and leaves the rest of
+    the source image untouched, so the cost follows the face size instead of the frame size.
+    img_rgb: HxWx3, uint8, the source image
+    M_c2o: 3x3, crop -> source image, in pixels of the crop
+    mask_crop: hxwx3 or hxw, uint8, the mask in crop space, same size as the crops
+    """
+
+    def __init__(self, img_rgb: np.ndarray, M_c2o: np.ndarray, mask_crop: np.ndarray):
+        h, w = img_rgb.shape[:2]
+        crop_h, crop_w = mask_crop.shape[:2]
+        self.img = img_rgb
+        M = np.eye(3)
+        M[:2] = np.asarray(M_c2o, dtype=np.float64)[:2]
+        M_o2c = np.linalg.inv(M)
+
+        # the crop can only land inside the bounding box of its warped corners
+        corners = np.array([[0, 0, 1], [crop_w, 0, 1], [0, crop_h, 1], [crop_w, crop_h, 1]], dtype=np.float64) @ M[:2].T
+        x0, y0 = np.maximum(np.floor(corners.min(axis=0)).astype(int) - 1, 0)
+        x1, y1 = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + 2, (w, h))
+        map_x, map_y = self._make_maps(M_o2c, x0, y0, x1, y1)
+
+        mask = mask_crop[..., 0] if mask_crop.ndim == 3 else mask_crop
+        mask_roi = cv2.remap(mask, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        # shrink to where the warped mask is non-zero, outside of it the source is kept as is
+        ys, xs = np.nonzero(mask_roi)
+        if len(ys) == 0:
+            self.roi = None
+            return
+        ry0, ry1, rx0, rx1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        self.roi = (slice(y0 + ry0, y0 + ry1), slice(x0 + rx0, x0 + rx1))
+        self.map1, self.map2 = cv2.convertMaps(map_x[ry0:ry1, rx0:rx1], map_y[ry0:ry1, rx0:rx1], cv2.CV_16SC2)
+
+        # alpha in 0~256, the blend is (fg * alpha + bg * (256 - alpha) + 128) >> 8
+        alpha = (mask_roi[ry0:ry1, rx0:rx1].astype(np.uint16) * 256 + 127) // 255
+        self.alpha = alpha[..., None]  # h_roixw_roix1
+        self.bg_term = img_rgb[self.roi].astype(np.uint16) * (256 - self.alpha) + 128  # h_roixw_roix3
+
+    @staticmethod
+    def _make_maps(M_o2c, x0, y0, x1, y1):
+        ys, xs = np.mgrid[y0:y1, x0:x1].astype(np.float64)
+        map_x = M_o2c[0, 0] * xs + M_o2c[0, 1] * ys + M_o2c[0, 2]
+        map_y = M_o2c[1, 0] * xs + M_o2c[1, 1] * ys + M_o2c[1, 2]
+        return map_x.astype(np.float32), map_y.astype(np.float32)
+
+    def __call__(self, I_p_i: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """ I_p_i: hxwx3, uint8, an animated crop
+        out: optional HxWx3 uint8 buffer to write into
+        return: HxWx3, uint8
+        """
+        if out is None:
+            out = self.img.copy()
+        else:
+            out[...] = self.img
+        if self.roi is not None:
+            out[self.roi] = self.patch(I_p_i)
+        return out
+
+    def patch(self, I_p_i: np.ndarray) -> np.ndarray:
+        """ I_p_i: hxwx3, uint8, an animated crop
+        return: h_roixw_roix3, uint8, the pasted-back pixels of self.roi only
+        """
+        if self.roi is None:
+            return np.empty((0, 0, 3), dtype=np.uint8)
+        fg = cv2.remap(I_p_i, self.map1, self.map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        blended = fg.astype(np.uint16) * self.alpha
+        blended += self.bg_term
+        return (blended >> 8).astype(np.uint8)
+
+
+class PatchFrames(object):
+    """ pasted-back frames stored as one background image per source plus, for every frame, only the patch of the
+    region covered by the crop mask, the only part that changes from frame to frame
+
+    The frames are in the same source-major order as the IMAGE outputs, n_frames per source; the patches are uint8,
+    so the memory goes down by 4x the ratio of the frame area to the mask area compared to float32 full frames.
+    composite() rebuilds full frames for a range of frames, iter_chunks() chunk by chunk, e.g. while encoding.
+    The sources can have different sizes: the frames of a source have the shape of its background, composite()
+    then needs a range of frames of one shape, composite_groups() and iter_chunks() split the frames by shape.
+    """
+
+    def __init__(self, n_sources, n_frames):
+        self.n_sources = n_sources
+        self.n_frames = n_frames  # per source
+        self.backgrounds = [None] * n_sources  # HxWx3, uint8 tensors
+        self.rois = [None] * n_sources  # (slice y, slice x), None when the mask is empty
+        self.patches = [None] * n_sources  # n_framesxh_roixw_roix3, uint8 tensors
+
+    def __len__(self):
+        return self.n_sources * self.n_frames
+
+    def source_shape(self, source_index):
+        return tuple(self.backgrounds[source_index].shape)
+
+    @property
+    def frame_shape(self):
+        """ the shape of every frame, a ValueError if the sources have different sizes """
+        shapes = {self.source_shape(i) for i, bg in enumerate(self.backgrounds) if bg is not None}
+        if len(shapes) != 1:
+            raise ValueError(f'The sources have different frame shapes {sorted(shapes)}, see PatchFrames.composite_groups')
+        return shapes.pop()
+
+    def set_source(self, source_index, img_rgb, roi):
+        """ img_rgb: HxWx3, uint8, the background of the frames of this source; roi: (slice y, slice x) or None """
+        self.backgrounds[source_index] = torch.from_numpy(np.ascontiguousarray(img_rgb))
+        self.rois[source_index] = roi
+        h, w = (0, 0) if roi is None else (roi[0].stop - roi[0].start, roi[1].stop - roi[1].start)
+        self.patches[source_index] = torch.empty((self.n_frames, h, w, 3), dtype=torch.uint8)
+
+    def write_batch(self, source_index, frame_index, patches):
+        """ patches: Nxh_roixw_roix3, uint8 tensor or array, or a sequence of h_roixw_roix3 uint8 arrays """
+        if not isinstance(patches, torch.Tensor):
+            patches = torch.from_numpy(np.ascontiguousarray(np.stack(patches) if isinstance(patches, (list, tuple)) else patches))
+        self.patches[source_index][frame_index:frame_index + len(patches)].copy_(patches)
+
+    def nbytes(self):
+        return sum(t.nbytes for t in self.backgrounds + self.patches if t is not None)
+
+    def shape_ranges(self, start=0, stop=None):
+        """ [(start, stop, frame shape)]: the frames start..stop split into runs of consecutive frames of one shape """
+        stop = len(self) if stop is None else min(stop, len(self))
+        ranges = []
+        for source_index in range(start // self.n_frames if self.n_frames else 0, self.n_sources):
+            lo, hi = max(start, source_index * self.n_frames), min(stop, (source_index + 1) * self.n_frames)
+            if lo >= hi:
+                break
+            shape = self.source_shape(source_index)
+            if ranges and ranges[-1][2] == shape:
+                ranges[-1] = (ranges[-1][0], hi, shape)
+            else:
+                ranges.append((lo, hi, shape))
+        return ranges
+
+    def composite(self, start=0, stop=None, out=None) -> torch.Tensor:
+        """ the full frames start..stop, as an IMAGE: NxHxWx3 float32 in 0~1
+        the frames of the range must have one shape (see composite_groups), a ValueError otherwise
+        out: optional float32 buffer of at least stop - start frames to write into
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        ranges = self.shape_ranges(start, stop)
+        if len(ranges) > 1:
+            raise ValueError(f'Frames {start}..{stop} have different shapes {[shape for _, _, shape in ranges]}, '
+                             f'composite them by shape with PatchFrames.composite_groups')
+        if out is None:
+            out = torch.empty((max(stop - start, 0), *(ranges[0][2] if ranges else self.frame_shape)), dtype=torch.float32)
+        for index in range(start, stop):
+            source_index, frame_index = divmod(index, self.n_frames)
+            frame = out[index - start]
+            frame.copy_(self.backgrounds[source_index])
+            roi = self.rois[source_index]
+            if roi is not None:
+                frame[roi].copy_(self.patches[source_index][frame_index])
+            frame.div_(255)
+        return out[:stop - start]
+
+    def composite_groups(self, start=0, stop=None) -> list:
+        """ [(start, NxHxWx3 float32 frames)]: the full frames start..stop, one IMAGE per run of frames of one shape """
+        return [(lo, self.composite(lo, hi)) for lo, hi, _ in self.shape_ranges(start, stop)]
+
+    def iter_chunks(self, chunk_size):
+        """ yields (start, full frames of start..start+chunk_size), reusing one buffer per frame shape;
+        a chunk never spans two shapes, so it can be shorter than chunk_size where the shape changes """
+        buffers = {}
+        for lo, hi, shape in self.shape_ranges():
+            if shape not in buffers:
+                buffers[shape] = torch.empty((min(chunk_size, len(self)), *shape), dtype=torch.float32)
+            for start in range(lo, hi, chunk_size):
+                yield start, self.composite(start, min(start + chunk_size, hi), out=buffers[shape])
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+"""
+process-wide pool of the onnxruntime / InsightFace sessions used by the cropper, built and warmed up once
+"""
+
+import os.path as osp
+import threading
+
+import onnxruntime
+
+from .landmark_runner import LandmarkRunner
+from .face_analysis_diy import FaceAnalysisDIY
+
+
+class SessionPool(object):
+    """ sessions keyed by (kind, provider, device, model path)
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = factory()
+                self._sessions[key] = session
+            return session
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+SESSION_POOL = SessionPool()
+
+
+def default_onnx_provider() -> str:
+    """ 'cuda' when onnxruntime was built with it, 'cpu' otherwise
+    """
+    return 'cuda' if 'CUDAExecutionProvider' in onnxruntime.get_available_providers() else 'cpu'
+
+
+def onnx_execution_providers(onnx_provider) -> list:
+    return ['CUDAExecutionProvider'] if onnx_provider.lower() == 'cuda' else ['CPUExecutionProvider']
+
+
+def get_landmark_runner(ckpt_path, onnx_provider='cuda', device_id=0, num_threads=4) -> LandmarkRunner:
+    def _build():
+        landmark_runner = LandmarkRunner(ckpt_path=ckpt_path, onnx_provider=onnx_provider, device_id=device_id, num_threads=num_threads)
+        landmark_runner.warmup()
+        return landmark_runner
+
+    key = ('landmark', onnx_provider.lower(), device_id, num_threads, osp.realpath(ckpt_path))
+    return SESSION_POOL.get(key, _build)
+
+
+def get_face_analysis(name='buffalo_l', root='~/.insightface', providers=('CUDAExecutionProvider',), device_id=0, det_size=(512, 512)) -> FaceAnalysisDIY:
+    def _build():
+        face_analysis = FaceAnalysisDIY(name=name, root=root, providers=list(providers))
+        face_analysis.prepare(ctx_id=device_id, det_size=det_size)
+        face_analysis.warmup()
+        return face_analysis
+
+    key = ('face_analysis', tuple(providers), device_id, osp.realpath(osp.expanduser(osp.join(root, name))), tuple(det_size))
+    return SESSION_POOL.get(key, _build)
@@ -4,7 +4,10 @@
 functions for processing video
 """
 
+import hashlib
 import os.path as osp
+import queue
+import threading
 import numpy as np
 import subprocess
 import imageio
@@ -13,6 +16,7 @@ import cv2
 from rich.progress import track
 from .helper import prefix
 from .rprint import rprint as print
+from .rprint import rlog as log
 
 
 def exec_cmd(cmd):
@@ -108,11 +112,17 @@ class VideoWriter:
         self.pixelformat = kwargs.get('pixelformat', 'yuv420p')
         self.image_mode = kwargs.get('image_mode', 'rgb')
         self.ffmpeg_params = kwargs.get('ffmpeg_params')
+        if kwargs.get('crf') is not None:
+            self.ffmpeg_params = list(self.ffmpeg_params or []) + ['-crf', str(kwargs['crf'])]
+            if self.codec == 'libvpx-vp9':
+                # vp9 treats crf as a quality cap on its default bitrate unless the bitrate is 0
+                self.ffmpeg_params += ['-b:v', '0']
+        self.macro_block_size = kwargs.get('macro_block_size', 16)
 
         self.writer = imageio.get_writer(
             self.wfp, fps=self.fps, format=self.video_format,
             codec=self.codec, quality=self.quality,
-            ffmpeg_params=self.ffmpeg_params, pixelformat=self.pixelformat
+            ffmpeg_params=self.ffmpeg_params, pixelformat=self.pixelformat, macro_block_size=self.macro_block_size
         )
 
     def write(self, image):
@@ -124,6 +134,45 @@ class VideoWriter:
     def close(self):
         if self.writer is not None:
             self.writer.close()
+            self.writer = None
+
+
+# codecs of the video sink and the container they are written to
+VIDEO_CODECS = {'libx264': 'mp4', 'libx265': 'mp4', 'libvpx-vp9': 'webm'}
+
+
+class VideoSink(object):
+    """ encodes the frames of several sources to one video file each, while they are rendered
+
+    The frames of a source must arrive in order; the writer of a source is opened on its first frame,
+    ffmpeg encodes in its own process so the encoding runs alongside the rendering.
+    wfps: one output path per source; kwargs: passed to VideoWriter (fps, codec, crf, ...)
+    """
+
+    def __init__(self, wfps, **kwargs):
+        self.wfps = list(wfps)
+        self.kwargs = kwargs
+        self.writers = [None] * len(self.wfps)
+        self.n_frames = [0] * len(self.wfps)
+
+    def write_batch(self, source_index, frames):
+        """ frames: a sequence of HxWx3 uint8 frames of source source_index """
+        if self.writers[source_index] is None:
+            self.writers[source_index] = VideoWriter(wfp=self.wfps[source_index], **self.kwargs)
+        for frame in frames:
+            self.writers[source_index].write(frame)
+        self.n_frames[source_index] += len(frames)
+
+    def close(self):
+        for writer in self.writers:
+            if writer is not None:
+                writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def change_video_fps(input_file, output_file, fps=20, codec='libx264', crf=5):
@@ -137,3 +186,150 @@ def get_fps(filepath):
     video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
     fps = eval(video_stream['avg_frame_rate'])
     return fps
+
+
+def resample_frame_indices(n_frames, fps, target_fps):
+    """ the frames of a clip of n_frames at fps to show at target_fps, the nearest one in time for every output frame;
+    all the frames when target_fps is 0 or not below fps, frames are never repeated
+    """
+    if target_fps <= 0 or fps <= 0 or target_fps >= fps:
+        return np.arange(n_frames)
+    n_out = int(np.ceil(n_frames * target_fps / fps - 1e-6))
+    return np.minimum(np.round(np.arange(n_out) * fps / target_fps).astype(int), n_frames - 1)
+
+
+class DrivingVideo(object):
+    """ a driving video file decoded lazily, chunk by chunk, instead of a fully decoded IMAGE batch
+
+    The frames are downscaled as they are decoded so that the longer side is at most max_side (0 keeps the size),
+    M only ever sees them at 256x256 and the landmarks of the retargeting do not need more than a few hundred pixels.
+    A background thread decodes up to prefetch chunks ahead of the consumer.
+    start_frame, frame_count: the range of frames to use, frame_count 0 for all the frames from start_frame
+    target_fps: only the frames nearest to the timestamps of target_fps are decoded, see resample_frame_indices
+    """
+
+    def __init__(self, path, start_frame=0, frame_count=0, max_side=512, prefetch=2, target_fps=0):
+        if not osp.isfile(path):
+            raise FileNotFoundError(f'Driving video not found: {path}')
+        self.path = path
+        self.max_side = max_side
+        self.prefetch = prefetch
+
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            raise ValueError(f'Cannot open the driving video: {path}')
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.source_fps = cap.get(cv2.CAP_PROP_FPS) or 30.
+        self.source_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if total <= 0:
+            # some containers (webm, gif, ...) do not store the frame count, the frames are counted by grabbing them once
+            total = 0
+            while cap.grab():
+                total += 1
+            log(f'{path}: no frame count in the header, counted {total} frames')
+        cap.release()
+        if total <= 0:
+            raise ValueError(f'The driving video has no frames: {path}')
+
+        self.start_frame = min(max(start_frame, 0), total)
+        self.range_frames = total - self.start_frame if frame_count <= 0 else min(frame_count, total - self.start_frame)
+        self.resample(target_fps)
+        if self.n_frames <= 0:
+            raise ValueError(f'No driving frames from frame {start_frame} of {path}, which has {total} frames')
+        w, h = self.source_size
+        scale = max_side / max(w, h) if max_side > 0 and max(w, h) > max_side else 1.
+        self.size = (max(int(round(w * scale)), 1), max(int(round(h * scale)), 1))  # (w, h) of the decoded frames
+
+    def __len__(self):
+        return self.n_frames
+
+    def resample(self, target_fps):
+        """ decode only the frames of target_fps from the range, 0 for all of them; in place """
+        self.frame_indices = resample_frame_indices(self.range_frames, self.source_fps, target_fps)  # relative to start_frame
+        self.n_frames = len(self.frame_indices)
+        self.fps = self.source_fps if self.n_frames == self.range_frames else target_fps
+        return self
+
+    def content_key(self) -> str:
+        """ hash of the file content and of the frames selected from it, for the motion cache """
+        h = hashlib.blake2b(digest_size=20)
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(f'{self.start_frame}:{self.size}'.encode())
+        h.update(np.ascontiguousarray(self.frame_indices, dtype=np.int64).data)
+        return h.hexdigest()
+
+    def _decode(self, chunk_size):
+        """ generator of TxHxWx3 uint8 chunks, in the calling thread """
+        cap = cv2.VideoCapture(self.path)
+        try:
+            if self.start_frame > 0:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+            position, last = 0, None
+            for start in range(0, self.n_frames, chunk_size):
+                chunk = np.empty((min(chunk_size, self.n_frames - start), self.size[1], self.size[0], 3), dtype=np.uint8)
+                for i in range(len(chunk)):
+                    # the frames that are not selected are only grabbed, not converted
+                    ok = True
+                    while ok and position < self.frame_indices[start + i]:
+                        ok = cap.grab()
+                        position += 1
+                    ok, frame = cap.read() if ok else (False, None)
+                    position += 1
+                    if not ok:
+                        if last is None:
+                            raise ValueError(f'Cannot decode the driving video: {self.path}')
+                        # the frame count in the header can be off by a few frames, the last frame is repeated
+                        log(f'{self.path}: ended at frame {self.start_frame + position - 1}, repeating the last frame')
+                        chunk[i:] = last
+                        break
+                    if frame.shape[1::-1] != self.size:
+                        frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+                    last = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=chunk[i])
+                yield chunk
+        finally:
+            cap.release()
+
+    def iter_chunks(self, chunk_size):
+        """ TxHxWx3 uint8 chunks of chunk_size frames, decoded ahead by a background thread """
+        if self.prefetch <= 0:
+            yield from self._decode(chunk_size)
+            return
+
+        chunks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def decoder():
+            try:
+                for chunk in self._decode(chunk_size):
+                    if not put(chunk):
+                        return
+                put(end)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=decoder, name='driving-video-decoder', daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = chunks.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
@@ -1,6 +1,6 @@
 import os
+import copy
 import torch
-import yaml
 import folder_paths
 import comfy.model_management as mm
 import comfy.utils
@@ -10,16 +10,21 @@ script_directory = os.path.dirname(os.path.abspath(__file__))
 from .liveportrait.config.argument_config import ArgumentConfig
 from .liveportrait.live_portrait_pipeline import LivePortraitPipeline
 from .liveportrait.utils.cropper import Cropper
-from .liveportrait.modules.spade_generator import SPADEDecoder
-from .liveportrait.modules.warping_network import WarpingNetwork
-from .liveportrait.modules.motion_extractor import MotionExtractor
-from .liveportrait.modules.appearance_feature_extractor import AppearanceFeatureExtractor
-from .liveportrait.modules.stitching_retargeting_network import StitchingRetargetingNetwork
+from .liveportrait.utils.paste_back import PatchFrames
+from .liveportrait.utils.video import VideoSink, VIDEO_CODECS, DrivingVideo, resample_frame_indices
+from .liveportrait.model_registry import MODEL_REGISTRY
+from .liveportrait.utils.motion_cache import MotionCache
+
+# driving motion reused across runs, keyed by the content of the driving frames; in memory, and also on disk when
+# LIVEPORTRAIT_MOTION_CACHE_DIR is set, where it is kept under LIVEPORTRAIT_MOTION_CACHE_MB
+MOTION_CACHE = MotionCache(os.environ.get("LIVEPORTRAIT_MOTION_CACHE_DIR") or None,
+                           max_disk_mb=int(os.environ.get("LIVEPORTRAIT_MOTION_CACHE_MB", 1024)))
 
 class InferenceConfig:
     def __init__(self,
                     mask_crop = None,
                     flag_use_half_precision=True,
+                    half_precision_dtype='auto',
                     flag_lip_zero=True,
                     lip_zero_threshold=0.03,
                     flag_eye_retargeting=False,
@@ -30,12 +35,19 @@ class InferenceConfig:
                     input_shape=(256, 256),
                     flag_write_result=True,
                     flag_pasteback=True,
+                    pasteback_backend='auto',
+                    output_mode='both',
                     ref_max_shape=1280,
                     ref_shape_n=2,
                     device_id=0,
                     flag_do_crop=True,
-                    flag_do_rot=True):
+                    flag_do_rot=True,
+                    source_batch_size=4,
+                    batch_size=1,
+                    pipeline_queue_depth=2,
+                    num_threads=0):
         self.flag_use_half_precision = flag_use_half_precision
+        self.half_precision_dtype = half_precision_dtype
         self.flag_lip_zero = flag_lip_zero
         self.lip_zero_threshold = lip_zero_threshold
         self.flag_eye_retargeting = flag_eye_retargeting
@@ -46,12 +58,18 @@ class InferenceConfig:
         self.input_shape = input_shape
         self.flag_write_result = flag_write_result
         self.flag_pasteback = flag_pasteback
+        self.pasteback_backend = pasteback_backend
+        self.output_mode = output_mode
         self.ref_max_shape = ref_max_shape
         self.ref_shape_n = ref_shape_n
         self.device_id = device_id
         self.flag_do_crop = flag_do_crop
         self.flag_do_rot = flag_do_rot
         self.mask_crop=mask_crop
+        self.source_batch_size = source_batch_size
+        self.batch_size = batch_size
+        self.pipeline_queue_depth = pipeline_queue_depth
+        self.num_threads = num_threads
 
 class CropConfig:
     def __init__(self, dsize=512, scale=2.3, vx_ratio=0, vy_ratio=-0.125):
@@ -60,6 +78,48 @@ class CropConfig:
         self.vx_ratio = vx_ratio
         self.vy_ratio = vy_ratio
 
+class FrameBuffer:
+    """ frames written by index into one float32 NHWC IMAGE tensor, allocated on the first write,
+    so that the output never exists as lists of numpy frames; anything with the same write method can be a sink
+    """
+    def __init__(self, n_frames):
+        self.n_frames = n_frames
+        self.images = None
+
+    def _allocate(self, frame_shape):
+        if self.images is None:
+            self.images = torch.empty((self.n_frames, *frame_shape), dtype=torch.float32)
+
+    def write(self, index, frame):
+        """ frame: HxWx3, uint8 """
+        self._allocate(frame.shape)
+        self.images[index].copy_(torch.from_numpy(frame)).div_(255)
+
+    def write_batch(self, index, frames):
+        """ frames: NxHxWx3 float tensor in 0~1, or a sequence of HxWx3 uint8 frames """
+        if isinstance(frames, torch.Tensor):
+            self._allocate(frames.shape[1:])
+            self.images[index:index + len(frames)].copy_(frames)
+        else:
+            for k, frame in enumerate(frames):
+                self.write(index + k, frame)
+
+def connected_outputs(prompt, unique_id):
+    """ the indices of the outputs of node unique_id that other nodes of the prompt take as input, None if unknown """
+    if prompt is None or unique_id is None:
+        return None
+    connected = set()
+    for node in prompt.values():
+        for value in node.get('inputs', {}).values():
+            # links are [source node id, output index]
+            if isinstance(value, list) and len(value) == 2 and str(value[0]) == str(unique_id):
+                connected.add(value[1])
+    return connected
+
+def empty_image():
+    """ placeholder IMAGE for an output that was not computed """
+    return torch.zeros((1, 64, 64, 3), dtype=torch.float32)
+
 class ArgumentConfig:
     def __init__(self,
                     device_id=0,
@@ -94,6 +154,9 @@ class DownloadAndLoadLivePortraitModels:
     @classmethod
     def INPUT_TYPES(s):
         return {"required": {
+            "device": (["auto", "cpu"], {"default": "auto", "tooltip": "auto uses the ComfyUI device"}),
+            "precision": (["auto", "fp32", "bf16"], {"default": "auto", "tooltip": "auto: fp16 on CUDA, fp32 on CPU; bf16: on CUDA and on CPUs with native bf16 support"}),
+            "cpu_threads": ("INT", {"default": 0, "min": 0, "max": 256, "tooltip": "torch intra-op threads on cpu while LivePortrait runs, restored afterwards; 0 keeps the torch default"}),
             },
         }
 
@@ -102,11 +165,11 @@ class DownloadAndLoadLivePortraitModels:
     FUNCTION = "loadmodel"
     CATEGORY = "LivePortrait"
 
-    def loadmodel(self):
-        device = mm.get_torch_device()
+    def loadmodel(self, device="auto", precision="auto", cpu_threads=0):
+        device = mm.get_torch_device() if device == "auto" else torch.device(device)
         mm.soft_empty_cache()
 
-        pbar = comfy.utils.ProgressBar(3)
+        pbar = comfy.utils.ProgressBar(4)
 
         download_path = os.path.join(folder_paths.models_dir, "liveportrait")
         model_path = os.path.join(download_path)
@@ -118,90 +181,23 @@ class DownloadAndLoadLivePortraitModels:
                                 local_dir=download_path,
                                 local_dir_use_symlinks=False)
 
-        model_config_path = os.path.join(script_directory, 'liveportrait', 'config', 'models.yaml')
-        with open(model_config_path, 'r') as file:
-            model_config = yaml.safe_load(file)
-        
-        feature_extractor_path = os.path.join(model_path, 'appearance_feature_extractor.safetensors')
-        motion_extractor_path = os.path.join(model_path, 'motion_extractor.safetensors')
-        warping_module_path = os.path.join(model_path, 'warping_module.safetensors')
-        spade_generator_path = os.path.join(model_path, 'spade_generator.safetensors')
-        stitching_retargeting_path = os.path.join(model_path, 'stitching_retargeting_module.safetensors')
-
-        # init F
-        model_params = model_config['model_params']['appearance_feature_extractor_params']
-        self.appearance_feature_extractor = AppearanceFeatureExtractor(**model_params).to(device)
-        self.appearance_feature_extractor.load_state_dict(comfy.utils.load_torch_file(feature_extractor_path))
-        self.appearance_feature_extractor.eval()
-        print('Load appearance_feature_extractor done.')
-        pbar.update(1)
-        # init M
-        model_params = model_config['model_params']['motion_extractor_params']
-        self.motion_extractor = MotionExtractor(**model_params).to(device)
-        self.motion_extractor.load_state_dict(comfy.utils.load_torch_file(motion_extractor_path))
-        self.motion_extractor.eval()
-        print('Load motion_extractor done.')
-        pbar.update(1)
-        # init W
-        model_params = model_config['model_params']['warping_module_params']
-        self.warping_module = WarpingNetwork(**model_params).to(device)
-        self.warping_module.load_state_dict(comfy.utils.load_torch_file(warping_module_path))
-        self.warping_module.eval()
-        print('Load warping_module done.')
-        pbar.update(1)
-        # init G
-        model_params = model_config['model_params']['spade_generator_params']
-        self.spade_generator = SPADEDecoder(**model_params).to(device)
-        self.spade_generator.load_state_dict(comfy.utils.load_torch_file(spade_generator_path))
-        self.spade_generator.eval()
-        print('Load spade_generator done.')
-        pbar.update(1)
-
-        def filter_checkpoint_for_model(checkpoint, prefix):
-            """Filter and adjust the checkpoint dictionary for a specific model based on the prefix."""
-            # Create a new dictionary where keys are adjusted by removing the prefix and the model name
-            filtered_checkpoint = {key.replace(prefix + "_module.", ""): value for key, value in checkpoint.items() if key.startswith(prefix)}
-            return filtered_checkpoint
-
-        config = model_config['model_params']['stitching_retargeting_module_params']
-        checkpoint = comfy.utils.load_torch_file(stitching_retargeting_path)
-
-        stitcher_prefix = 'retarget_shoulder'
-        stitcher_checkpoint = filter_checkpoint_for_model(checkpoint, stitcher_prefix)
-        stitcher = StitchingRetargetingNetwork(**config.get('stitching'))
-        stitcher.load_state_dict(stitcher_checkpoint)
-        stitcher = stitcher.to(device)
-        stitcher.eval()
-
-        lip_prefix = 'retarget_mouth'
-        lip_checkpoint = filter_checkpoint_for_model(checkpoint, lip_prefix)
-        retargetor_lip = StitchingRetargetingNetwork(**config.get('lip'))
-        retargetor_lip.load_state_dict(lip_checkpoint)
-        retargetor_lip = retargetor_lip.to(device)
-        retargetor_lip.eval()
-
-        eye_prefix = 'retarget_eye'
-        eye_checkpoint = filter_checkpoint_for_model(checkpoint, eye_prefix)
-        retargetor_eye = StitchingRetargetingNetwork(**config.get('eye'))
-        retargetor_eye.load_state_dict(eye_checkpoint)
-        retargetor_eye = retargetor_eye.to(device)
-        retargetor_eye.eval()
-        print('Load stitching_retargeting_module done.')
-
-        self.stich_retargeting_module = {
-            'stitching': stitcher,
-            'lip': retargetor_lip,
-            'eye': retargetor_eye
-        }
+        # the networks are shared process-wide, only the first load for this path/device reads the weights
+        key, models = MODEL_REGISTRY.acquire(model_path, device, torch.float32, pbar=pbar)
 
         pipeline = LivePortraitPipeline(
-            self.appearance_feature_extractor,
-            self.motion_extractor,
-            self.warping_module,
-            self.spade_generator,
-            self.stich_retargeting_module,
-            InferenceConfig()
+            models['appearance_feature_extractor'],
+            models['motion_extractor'],
+            models['warping_module'],
+            models['spade_generator'],
+            models['stitching_retargeting_module'],
+            InferenceConfig(
+                flag_use_half_precision=precision != "fp32",
+                half_precision_dtype="bfloat16" if precision == "bf16" else "auto",
+                num_threads=cpu_threads,
+            )
         )
+        MODEL_REGISTRY.bind(pipeline, key)
+        pipeline.motion_cache = MOTION_CACHE
 
         return (pipeline,)
 
@@ -212,7 +208,6 @@ class LivePortraitProcess:
 
             "pipeline": ("LIVEPORTRAITPIPE",),
             "source_image": ("IMAGE",),
-            "driving_images": ("IMAGE",),
             "dsize": ("INT", {"default": 512, "min": 64, "max": 2048}),
             "scale": ("FLOAT", {"default": 2.3, "min": 1.0, "max": 4.0, "step": 0.01}),
             "vx_ratio": ("FLOAT", {"default": 0.0, "min": -1.0, "max": 1.0, "step": 0.01}),
@@ -224,28 +219,47 @@ class LivePortraitProcess:
             "lip_retargeting_multiplier": ("FLOAT", {"default": 1.0, "min": 0.01, "max": 10.0, "step": 0.001}),
             "stitching": ("BOOLEAN", {"default": True}),
             "relative": ("BOOLEAN", {"default": True}),
+            "batch_size": ("INT", {"default": 1, "min": 1, "max": 64, "tooltip": "driving frames animated per step through M, stitching and W+G"}),
             },
+            "optional": {
+                "driving_images": ("IMAGE",),
+                "driving_video": ("LIVEPORTRAIT_DRIVING", {"tooltip": "a driving video file decoded chunk by chunk, instead of driving_images"}),
+                "driving_fps": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 240.0, "step": 0.01, "tooltip": "frame rate of driving_images, needed by target_fps (a driving_video knows its own)"}),
+                "target_fps": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 240.0, "step": 0.01, "tooltip": "animate only the driving frames nearest to the timestamps of this frame rate, 0 for every frame"}),
+                "output_mode": (["auto", "both", "crops", "full", "patches"], {"default": "both", "tooltip": "outputs to compute, the others are a 64x64 black placeholder; auto computes the connected ones, but then runs again on every queue since ComfyUI does not cache on the links"}),
+            },
+            "hidden": {"prompt": "PROMPT", "unique_id": "UNIQUE_ID"},
         }
 
-    RETURN_TYPES = ("IMAGE", "IMAGE",)
-    RETURN_NAMES = ("cropped_images", "full_images",)
+    RETURN_TYPES = ("IMAGE", "IMAGE", "LIVEPORTRAIT_PATCHES",)
+    RETURN_NAMES = ("cropped_images", "full_images", "full_patches",)
+    OUTPUT_TOOLTIPS = ("the animated crops; a 64x64 black placeholder unless output_mode computes them",
+                       "the crops pasted back into the source images; a 64x64 black placeholder unless output_mode computes them",
+                       "the full frames as patches, see LivePortrait Composite Patches; None unless output_mode is patches")
     FUNCTION = "process"
     CATEGORY = "LivePortrait"
 
-    def process(self, source_image, driving_images, dsize, scale, vx_ratio, vy_ratio, pipeline, 
-                lip_zero, eye_retargeting, lip_retargeting, stitching, relative, eyes_retargeting_multiplier, lip_retargeting_multiplier):
-        source_image_np = (source_image * 255).byte().numpy()
-        driving_images_np = (driving_images * 255).byte().numpy()
+    # outputs computed by the explicit output modes, as indices into RETURN_TYPES
+    OUTPUT_MODES = {"both": {0, 1}, "crops": {0}, "full": {1}, "patches": {2}}
 
+    @classmethod
+    def IS_CHANGED(s, output_mode="both", **kwargs):
+        # the cache key of ComfyUI covers the inputs but not the links of the outputs, and IS_CHANGED does not get the
+        # prompt to look them up: with auto, an output connected since the last run would be served as the placeholder
+        return float("nan") if output_mode == "auto" else ""
+
+    def configure(self, pipeline, dsize, scale, vx_ratio, vy_ratio, lip_zero, eye_retargeting, lip_retargeting, stitching, relative,
+                  eyes_retargeting_multiplier, lip_retargeting_multiplier, batch_size, output_mode):
+        """ set the options of the node on the pipeline, return the crop config """
         crop_cfg = CropConfig(
             dsize = dsize,
             scale = scale,
             vx_ratio = vx_ratio,
             vy_ratio = vy_ratio,
             )
-        
-        cropper = Cropper(crop_cfg=crop_cfg)
-        pipeline.cropper = cropper
+
+        # face detection follows the pipeline onto the cpu, otherwise uses cuda when onnxruntime has it
+        pipeline.cropper = Cropper(onnx_provider='cpu' if pipeline.live_portrait_wrapper.device.type == 'cpu' else None)
         pipeline.live_portrait_wrapper.cfg.flag_eye_retargeting = eye_retargeting
         pipeline.live_portrait_wrapper.cfg.eyes_retargeting_multiplier = eyes_retargeting_multiplier
         pipeline.live_portrait_wrapper.cfg.flag_lip_retargeting = lip_retargeting
@@ -253,32 +267,290 @@ class LivePortraitProcess:
         pipeline.live_portrait_wrapper.cfg.flag_stitching = stitching
         pipeline.live_portrait_wrapper.cfg.flag_relative = relative
         pipeline.live_portrait_wrapper.cfg.flag_lip_zero = lip_zero
-      
-        cropped_out_list = []
-        full_out_list = []
-        for img in source_image_np:
-            cropped_frames, full_frame = pipeline.execute(img, driving_images_np)
-            cropped_tensors = [torch.from_numpy(np_array) for np_array in cropped_frames]
-            cropped_tensors_out = torch.stack(cropped_tensors) / 255
-            cropped_tensors_out = cropped_tensors_out.cpu().float()
+        pipeline.live_portrait_wrapper.cfg.batch_size = batch_size
+        pipeline.live_portrait_wrapper.cfg.output_mode = output_mode
+
+        return crop_cfg
+
+    @staticmethod
+    def get_driving(driving_images=None, driving_video=None, driving_fps=0.0, target_fps=0.0):
+        """ the driving frames for the pipeline, with only the frames of target_fps, selected before any of them is processed """
+        if driving_video is not None:
+            # a copy, the node output is cached by ComfyUI
+            return copy.copy(driving_video).resample(target_fps) if target_fps > 0 else driving_video
+        if driving_images is None:
+            raise ValueError("LivePortraitProcess needs driving_images or driving_video")
+        if target_fps > 0:
+            if driving_fps <= 0:
+                raise ValueError("target_fps needs the driving_fps of driving_images")
+            frame_indices = resample_frame_indices(len(driving_images), driving_fps, target_fps)
+            if len(frame_indices) < len(driving_images):
+                driving_images = driving_images[torch.from_numpy(frame_indices)]
+        return driving_images
+
+    def process(self, source_image, dsize, scale, vx_ratio, vy_ratio, pipeline,
+                lip_zero, eye_retargeting, lip_retargeting, stitching, relative, eyes_retargeting_multiplier, lip_retargeting_multiplier, batch_size=1,
+                driving_images=None, driving_video=None, driving_fps=0.0, target_fps=0.0, output_mode="both", prompt=None, unique_id=None):
+        want_crops, want_frames, want_patches = self.resolve_outputs(output_mode, prompt, unique_id)
+        source_image_np = (source_image * 255).byte().numpy()
+        crop_cfg = self.configure(pipeline, dsize, scale, vx_ratio, vy_ratio, lip_zero, eye_retargeting, lip_retargeting, stitching, relative,
+                                  eyes_retargeting_multiplier, lip_retargeting_multiplier, batch_size, self.pipeline_output_mode(want_crops, want_frames, want_patches))
+
+        # the driving IMAGE batch goes to the pipeline as is and is resized on the device chunk by chunk (a driving video
+        # is decoded chunk by chunk), the driving motion is shared by all source images
+        driving = self.get_driving(driving_images, driving_video, driving_fps, target_fps)
+        return self.render_outputs(pipeline, list(source_image_np), driving, crop_cfg, want_frames, want_patches)
+
+    def resolve_outputs(self, output_mode, prompt=None, unique_id=None):
+        """ (crops, full_images, full_patches): which outputs to compute """
+        connected = connected_outputs(prompt, unique_id) if output_mode == "auto" else self.OUTPUT_MODES[output_mode]
+        if not connected:
+            connected = self.OUTPUT_MODES["both"]
+        return tuple(i in connected for i in range(3))
+
+    @staticmethod
+    def pipeline_output_mode(want_crops, want_frames, want_patches):
+        # the full frames are pasted back as patches when those are wanted, and composited from them if need be
+        return "both" if want_crops and (want_frames or want_patches) else "crops" if want_crops else "full"
+
+    @staticmethod
+    def render_outputs(pipeline, sources, driving, crop_cfg, want_frames, want_patches):
+        """ run the pipeline and return the node outputs, the frames are written into them as they are produced,
+        an output that is not computed is never allocated """
+        n_frames = len(driving)
+        cropped_out = FrameBuffer(len(sources) * n_frames)
+        full_out = FrameBuffer(len(sources) * n_frames)
+        patches_out = PatchFrames(len(sources), n_frames) if want_patches else None
+        for step in pipeline.execute_iter(sources, driving, crop_cfg, as_tensor=True, as_patches=want_patches):
+            for j, source_index in enumerate(step['source_indices']):
+                index = source_index * n_frames + step['frame_index']  # source-major
+                cropped_out.write_batch(index, step['I_p'][j])
+                if want_patches:
+                    if step['frame_index'] == 0:
+                        patches_out.set_source(source_index, *step['paste_roi'][j])
+                    patches_out.write_batch(source_index, step['frame_index'], step['I_p_paste'][j])
+                else:
+                    full_out.write_batch(index, step['I_p_paste'][j])
+
+        if want_patches and want_frames:
+            full_out.images = patches_out.composite()
+        cropped_tensors_out = cropped_out.images if cropped_out.images is not None else empty_image()
+        full_tensors_out = full_out.images if full_out.images is not None else empty_image()
+
+        return (cropped_tensors_out, full_tensors_out, patches_out)
+
+class LivePortraitComposite:
+    """ full frames from the full_patches of LivePortraitProcess, optionally only a range of them;
+    the frames of the range must have one size, an IMAGE batch cannot mix source images of different sizes """
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "full_patches": ("LIVEPORTRAIT_PATCHES",),
+            "start_index": ("INT", {"default": 0, "min": 0, "max": 0xffffffff}),
+            "frame_count": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "tooltip": "0 for all the frames from start_index"}),
+            },
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    RETURN_NAMES = ("full_images",)
+    FUNCTION = "composite"
+    CATEGORY = "LivePortrait"
+
+    def composite(self, full_patches, start_index=0, frame_count=0):
+        if full_patches is None or start_index >= len(full_patches):
+            return (empty_image(),)
+        stop = len(full_patches) if frame_count == 0 else start_index + frame_count
+        return (full_patches.composite(start_index, stop),)
+
+class LivePortraitProcessToVideo(LivePortraitProcess):
+    """ LivePortraitProcess that encodes the frames to video files while they are rendered, one file per source image,
+    instead of returning them, so that the memory stays constant however long the driving clip is """
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = super().INPUT_TYPES()
+        inputs["required"].update({
+            "filename_prefix": ("STRING", {"default": "LivePortrait"}),
+            "frames": (["full", "crops"], {"default": "full"}),
+            "fps": ("FLOAT", {"default": 30.0, "min": 1.0, "max": 120.0, "step": 0.01}),
+            "crf": ("INT", {"default": 19, "min": 0, "max": 51, "tooltip": "lower is better quality and bigger files"}),
+            "codec": (list(VIDEO_CODECS.keys()), {"default": "libx264"}),
+            })
+        inputs["optional"] = {key: inputs["optional"][key] for key in ("driving_images", "driving_video", "driving_fps", "target_fps")}
+        del inputs["hidden"]
+        return inputs
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("video_files",)
+    OUTPUT_TOOLTIPS = ("the paths of the video files, one per line",)
+    FUNCTION = "render"
+    OUTPUT_NODE = True
+    CATEGORY = "LivePortrait"
+
+    def render(self, source_image, pipeline, filename_prefix, frames, fps, crf, codec, driving_images=None, driving_video=None,
+               driving_fps=0.0, target_fps=0.0, batch_size=1, **kwargs):
+        driving = self.get_driving(driving_images, driving_video, driving_fps, target_fps)
+        source_image_np = (source_image * 255).byte().numpy()
+        crop_cfg = self.configure(pipeline, batch_size=batch_size, output_mode=frames, **kwargs)
+
+        full_output_folder, filename, counter, subfolder, _ = folder_paths.get_save_image_path(
+            filename_prefix, folder_paths.get_output_directory(), source_image.shape[2], source_image.shape[1])
+        wfps = [os.path.join(full_output_folder, f"{filename}_{counter + i:05}_.{VIDEO_CODECS[codec]}") for i in range(len(source_image_np))]
+
+        # the frames go from the pipeline to ffmpeg step by step, nothing is kept
+        with VideoSink(wfps, fps=fps, codec=codec, crf=crf, format=VIDEO_CODECS[codec], macro_block_size=2) as sink:
+            for step in pipeline.execute_iter(list(source_image_np), driving, crop_cfg):
+                for j, source_index in enumerate(step['source_indices']):
+                    sink.write_batch(source_index, step['I_p'][j] if frames == "crops" else step['I_p_paste'][j])
+
+        return {"ui": {"text": wfps}, "result": ("\n".join(wfps),)}
+
+class LivePortraitExtractMotion:
+    """ the motion of the driving frames, everything LivePortraitRender needs from them; ComfyUI caches it,
+    so that it is extracted once for any number of renders and skipped when only the source or the render options change """
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = LivePortraitProcess.INPUT_TYPES()
+        return {"required": {
+            "pipeline": ("LIVEPORTRAITPIPE",),
+            "batch_size": inputs["required"]["batch_size"],
+            "retargeting_ratios": ("BOOLEAN", {"default": False, "tooltip": "also extract the eye and lip ratios of the driving frames, needed by eye_retargeting and lip_retargeting, costs a landmark detection per frame"}),
+            },
+            "optional": {key: inputs["optional"][key] for key in ("driving_images", "driving_video", "driving_fps", "target_fps")},
+        }
+
+    RETURN_TYPES = ("LIVEPORTRAIT_MOTION", "INT", "FLOAT",)
+    RETURN_NAMES = ("motion", "frame_count", "fps",)
+    FUNCTION = "extract"
+    CATEGORY = "LivePortrait"
+
+    def extract(self, pipeline, batch_size=1, retargeting_ratios=False, driving_images=None, driving_video=None, driving_fps=0.0, target_fps=0.0):
+        driving = LivePortraitProcess.get_driving(driving_images, driving_video, driving_fps, target_fps)
+        fps = driving.fps if driving_video is not None else target_fps if target_fps > 0 else driving_fps
+
+        pipeline.cropper = Cropper(onnx_provider='cpu' if pipeline.live_portrait_wrapper.device.type == 'cpu' else None)
+        pipeline.live_portrait_wrapper.cfg.flag_eye_retargeting = retargeting_ratios
+        pipeline.live_portrait_wrapper.cfg.flag_lip_retargeting = retargeting_ratios
+        pipeline.live_portrait_wrapper.cfg.batch_size = batch_size
+
+        motion = pipeline.extract_motion(driving, fps=fps)
+        return (motion, len(motion), motion.fps)
+
+class LivePortraitEncodeSource:
+    """ the source images cropped and encoded by F and M, with what the paste-back needs; ComfyUI caches it,
+    so that it is encoded once for any number of renders and skipped when only the driving or the render options change.
+    The cached source is kept on the cpu, LivePortraitRender moves it to the device for the render only """
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = LivePortraitProcess.INPUT_TYPES()
+        return {"required": {key: inputs["required"][key] for key in ("pipeline", "source_image", "dsize", "scale", "vx_ratio", "vy_ratio", "lip_zero")}}
+
+    RETURN_TYPES = ("LIVEPORTRAIT_SOURCE",)
+    RETURN_NAMES = ("source",)
+    FUNCTION = "encode"
+    CATEGORY = "LivePortrait"
+
+    def encode(self, pipeline, source_image, dsize, scale, vx_ratio, vy_ratio, lip_zero):
+        crop_cfg = CropConfig(dsize=dsize, scale=scale, vx_ratio=vx_ratio, vy_ratio=vy_ratio)
+        pipeline.cropper = Cropper(onnx_provider='cpu' if pipeline.live_portrait_wrapper.device.type == 'cpu' else None)
+        cfg = pipeline.live_portrait_wrapper.cfg
+        cfg.flag_lip_zero = lip_zero
+
+        source_image_np = (source_image * 255).byte().numpy()
+        with pipeline.live_portrait_wrapper.cpu_threads():
+            # the paste-back is prepared for any output of the render
+            return ([pipeline.source_to(pipeline.prepare_source(img_rgb, crop_cfg, with_paste_back=cfg.flag_pasteback), 'cpu')
+                     for img_rgb in source_image_np],)
+
+class LivePortraitRender(LivePortraitProcess):
+    """ LivePortraitProcess from the outputs of LivePortraitEncodeSource and LivePortraitExtractMotion,
+    only the stitching, retargeting, W and G run here """
+    @classmethod
+    def INPUT_TYPES(s):
+        inputs = super().INPUT_TYPES()
+        required = {
+            "pipeline": ("LIVEPORTRAITPIPE",),
+            "source": ("LIVEPORTRAIT_SOURCE",),
+            "motion": ("LIVEPORTRAIT_MOTION",),
+            }
+        required.update({key: inputs["required"][key] for key in ("eye_retargeting", "eyes_retargeting_multiplier", "lip_retargeting",
+                                                                  "lip_retargeting_multiplier", "stitching", "relative", "batch_size")})
+        for key in ("eye_retargeting", "lip_retargeting"):
+            required[key] = ("BOOLEAN", {"default": False, "tooltip": "needs a motion extracted with retargeting_ratios enabled"})
+        return {"required": required,
+                "optional": {"output_mode": inputs["optional"]["output_mode"]},
+                "hidden": inputs["hidden"],
+        }
+
+    FUNCTION = "render"
 
-            full_tensors = [torch.from_numpy(np_array) for np_array in full_frame]
-            full_tensors_out = torch.stack(full_tensors) / 255
-            full_tensors_out = full_tensors_out.cpu().float()
+    def render(self, pipeline, source, motion, eye_retargeting, eyes_retargeting_multiplier, lip_retargeting, lip_retargeting_multiplier,
+               stitching, relative, batch_size=1, output_mode="both", prompt=None, unique_id=None):
+        if (eye_retargeting or lip_retargeting) and not motion.has_ratios:
+            raise ValueError("LivePortraitRender: eye_retargeting and lip_retargeting need the eye and lip ratios of the driving frames, "
+                             "enable retargeting_ratios on LivePortrait Extract Motion")
+        want_crops, want_frames, want_patches = self.resolve_outputs(output_mode, prompt, unique_id)
+        cfg = pipeline.live_portrait_wrapper.cfg
+        cfg.flag_eye_retargeting = eye_retargeting
+        cfg.eyes_retargeting_multiplier = eyes_retargeting_multiplier
+        cfg.flag_lip_retargeting = lip_retargeting
+        cfg.lip_retargeting_multiplier = lip_retargeting_multiplier
+        cfg.flag_stitching = stitching
+        cfg.flag_relative = relative
+        cfg.batch_size = batch_size
+        cfg.output_mode = self.pipeline_output_mode(want_crops, want_frames, want_patches)
 
-            cropped_out_list.append(cropped_tensors_out)
-            full_out_list.append(full_tensors_out)
+        return self.render_outputs(pipeline, list(source), motion, None, want_frames, want_patches)
 
-        cropped_tensors_out = torch.cat(cropped_out_list, dim=0)
-        full_tensors_out = torch.cat(full_out_list, dim=0)
+class LivePortraitLoadDrivingVideo:
+    """ a driving video file for LivePortraitProcess, decoded chunk by chunk by a background thread while rendering
+    and downscaled at decode time, instead of a fully decoded IMAGE batch at full resolution """
+    VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v', '.gif')
 
-        return (cropped_tensors_out, full_tensors_out)
+    @classmethod
+    def INPUT_TYPES(s):
+        input_dir = folder_paths.get_input_directory()
+        files = sorted(f for f in os.listdir(input_dir) if f.lower().endswith(s.VIDEO_EXTENSIONS)) if os.path.isdir(input_dir) else []
+        return {"required": {
+            "video": (files,),
+            "start_frame": ("INT", {"default": 0, "min": 0, "max": 0xffffffff}),
+            "frame_count": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "tooltip": "0 for all the frames from start_frame"}),
+            "max_side": ("INT", {"default": 512, "min": 0, "max": 4096, "step": 8, "tooltip": "frames are downscaled while decoding to at most this size, 0 keeps the size"}),
+            "target_fps": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 240.0, "step": 0.01, "tooltip": "decode only the frames nearest to the timestamps of this frame rate, 0 for every frame"}),
+            },
+        }
+
+    RETURN_TYPES = ("LIVEPORTRAIT_DRIVING", "INT", "FLOAT",)
+    RETURN_NAMES = ("driving_video", "frame_count", "fps",)
+    FUNCTION = "load"
+    CATEGORY = "LivePortrait"
+
+    def load(self, video, start_frame=0, frame_count=0, max_side=512, target_fps=0.0):
+        path = video if os.path.isabs(video) else os.path.join(folder_paths.get_input_directory(), video)
+        driving_video = DrivingVideo(path, start_frame=start_frame, frame_count=frame_count, max_side=max_side, target_fps=target_fps)
+        return (driving_video, len(driving_video), driving_video.fps)
+
+    @classmethod
+    def IS_CHANGED(s, video, **kwargs):
+        path = video if os.path.isabs(video) else os.path.join(folder_paths.get_input_directory(), video)
+        return os.path.getmtime(path) if os.path.exists(path) else ""
 
 NODE_CLASS_MAPPINGS = {
     "DownloadAndLoadLivePortraitModels": DownloadAndLoadLivePortraitModels,
     "LivePortraitProcess": LivePortraitProcess,
+    "LivePortraitComposite": LivePortraitComposite,
+    "LivePortraitProcessToVideo": LivePortraitProcessToVideo,
+    "LivePortraitLoadDrivingVideo": LivePortraitLoadDrivingVideo,
+    "LivePortraitExtractMotion": LivePortraitExtractMotion,
+    "LivePortraitEncodeSource": LivePortraitEncodeSource,
+    "LivePortraitRender": LivePortraitRender,
 }
 NODE_DISPLAY_NAME_MAPPINGS = {
     "DownloadAndLoadLivePortraitModels": "(Down)Load LivePortraitModels",
     "LivePortraitProcess": "LivePortraitProcess",
+    "LivePortraitComposite": "LivePortrait Composite Patches",
+    "LivePortraitProcessToVideo": "LivePortraitProcess To Video",
+    "LivePortraitLoadDrivingVideo": "LivePortrait Load Driving Video",
+    "LivePortraitExtractMotion": "LivePortrait Extract Motion",
+    "LivePortraitEncodeSource": "LivePortrait Encode Source",
+    "LivePortraitRender": "LivePortrait Render",
     }
\ No newline at end of file
@@ -0,0 +1,7 @@
+# coding: utf-8
+
+import os.path as osp
+import sys
+
+# the liveportrait package is imported from the repository root, without ComfyUI
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
@@ -0,0 +1,192 @@
+# coding: utf-8
+
+"""
+correctness of the LivePortrait networks and wrapper on the cpu, with small random-weight networks
+"""
+
+import copy
+import os.path as osp
+
+import numpy as np
+import pytest
+import torch
+import yaml
+
+from liveportrait import live_portrait_wrapper
+from liveportrait.config.inference_config import InferenceConfig
+from liveportrait.live_portrait_wrapper import LivePortraitWrapper
+from liveportrait.modules.appearance_feature_extractor import AppearanceFeatureExtractor
+from liveportrait.modules.motion_extractor import MotionExtractor
+from liveportrait.modules.spade_generator import SPADEDecoder
+from liveportrait.modules.stitching_retargeting_network import StitchingRetargetingNetwork
+from liveportrait.modules.util import freeze_for_inference
+from liveportrait.modules.warping_network import WarpingNetwork
+from liveportrait.utils.retargeting_utils import compute_eye_delta, compute_lip_delta
+
+NUM_KP = 21
+MODELS_YAML = osp.join(osp.dirname(osp.dirname(osp.abspath(__file__))), 'liveportrait', 'config', 'models.yaml')
+
+# the layout of config/models.yaml with fewer channels, so that a forward runs in well under a second
+F_PARAMS = dict(image_channel=3, block_expansion=8, num_down_blocks=2, max_features=32, reshape_channel=8, reshape_depth=4, num_resblocks=1)
+W_PARAMS = dict(num_kp=NUM_KP, block_expansion=8, max_features=32, num_down_blocks=2, reshape_channel=8, estimate_occlusion_map=True,
+                dense_motion_params=dict(block_expansion=8, max_features=32, num_blocks=2, reshape_depth=4, compress=2))
+G_PARAMS = dict(upscale=2, block_expansion=8, max_features=32, num_down_blocks=2)
+M_PARAMS = dict(num_kp=NUM_KP, backbone='convnextv2_tiny')
+
+
+def _randomize_batch_norms(model, generator):
+    # fresh BatchNorms are the identity in eval mode, which would hide a wrong folding
+    for module in model.modules():
+        if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+            module.running_mean.copy_(torch.randn(module.running_mean.shape, generator=generator) * 0.1)
+            module.running_var.copy_(torch.rand(module.running_var.shape, generator=generator) + 0.5)
+    return model
+
+
+def _damp_output(generator_module, factor=0.05):
+    # random weights drive the final sigmoid of G into saturation, where any rounding flips whole pixels
+    for parameter in generator_module.conv_img.parameters():
+        parameter.mul_(factor)
+    return generator_module
+
+
+def build_networks(seed=0):
+    torch.manual_seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+    with open(MODELS_YAML, 'r') as f:
+        config = yaml.safe_load(f)['model_params']['stitching_retargeting_module_params']
+    with torch.no_grad():
+        networks = {
+            'appearance_feature_extractor': _randomize_batch_norms(AppearanceFeatureExtractor(**F_PARAMS), generator).eval(),
+            'motion_extractor': MotionExtractor(**M_PARAMS).eval(),
+            'warping_module': _randomize_batch_norms(WarpingNetwork(**W_PARAMS), generator).eval(),
+            'spade_generator': _damp_output(SPADEDecoder(**G_PARAMS)).eval(),
+            'stitching_retargeting_module': {name: StitchingRetargetingNetwork(**config[name]).eval() for name in ('stitching', 'lip', 'eye')},
+        }
+    return networks
+
+
+def make_wrapper(networks, **cfg_kwargs):
+    cfg = InferenceConfig(flag_use_half_precision=False)
+    for k, v in cfg_kwargs.items():
+        setattr(cfg, k, v)
+    return LivePortraitWrapper(cfg=cfg, **networks)
+
+
+@pytest.fixture(scope='module')
+def networks():
+    return build_networks()
+
+
+@pytest.fixture
+def no_cuda(monkeypatch):
+    """ any .cuda() call fails, the inputs must follow the device of the networks """
+    def _cuda(self, *args, **kwargs):
+        raise AssertionError('.cuda() called on the cpu')
+    monkeypatch.setattr(torch.Tensor, 'cuda', _cuda)
+    monkeypatch.setattr(torch.nn.Module, 'cuda', _cuda)
+
+
+def test_autocast_fp32_without_bf16(networks, monkeypatch):
+    monkeypatch.setattr(live_portrait_wrapper, 'cpu_supports_bf16', lambda: False)
+    for dtype in ('auto', 'bfloat16'):
+        wrapper = make_wrapper(networks, flag_use_half_precision=True, half_precision_dtype=dtype)
+        with wrapper.autocast():
+            assert not torch.is_autocast_enabled('cpu')
+            assert wrapper.spade_generator.fc.weight.dtype == torch.float32
+
+
+def test_autocast_bf16_on_cpu(networks, monkeypatch):
+    monkeypatch.setattr(live_portrait_wrapper, 'cpu_supports_bf16', lambda: True)
+    wrapper = make_wrapper(networks, flag_use_half_precision=True, half_precision_dtype='bfloat16')
+    with wrapper.autocast():
+        assert torch.is_autocast_enabled('cpu')
+        assert torch.get_autocast_dtype('cpu') == torch.bfloat16
+    # float16 is for cuda only, 'auto' stays in float32 on the cpu
+    with make_wrapper(networks, flag_use_half_precision=True, half_precision_dtype='auto').autocast():
+        assert not torch.is_autocast_enabled('cpu')
+
+
+def test_cpu_threads_restored(networks):
+    wrapper = make_wrapper(networks, num_threads=2)
+    previous = torch.get_num_threads()
+    with wrapper.cpu_threads():
+        assert torch.get_num_threads() == 2
+    assert torch.get_num_threads() == previous
+
+
+def test_inputs_on_network_device(networks, no_cuda):
+    wrapper = make_wrapper(networks)
+    assert wrapper.device.type == 'cpu'
+    rng = np.random.RandomState(0)
+
+    x = wrapper.prepare_source(rng.randint(0, 255, (200, 180, 3), dtype=np.uint8))
+    assert x.device == wrapper.device and x.shape == (1, 3, 256, 256)
+
+    frames = rng.randint(0, 255, (3, 256, 256, 3), dtype=np.uint8)
+    y = wrapper.prepare_driving_videos(list(frames))
+    assert y.device == wrapper.device and y.shape == (3, 1, 3, 256, 256)
+    assert torch.allclose(y[:, 0], torch.from_numpy(frames).permute(0, 3, 1, 2).float() / 255.)
+
+    images = torch.rand(2, 100, 120, 3)
+    z = wrapper.prepare_driving_images(images)
+    assert z.device == wrapper.device and z.shape == (2, 3, 256, 256)
+
+
+def test_retargeting_deltas_on_cpu(networks, no_cuda):
+    wrapper = make_wrapper(networks)
+    rng = np.random.RandomState(0)
+    source_lmk = rng.rand(203, 2).astype(np.float32) * 256
+    kp_source = torch.randn(1, NUM_KP, 3)
+    input_eye_ratios = rng.rand(4, 1, 1).astype(np.float32)
+    input_lip_ratios = rng.rand(4, 1, 1).astype(np.float32)
+
+    eye_delta = compute_eye_delta(2, input_eye_ratios, source_lmk, wrapper, kp_source)
+    lip_delta = compute_lip_delta(2, input_lip_ratios, source_lmk, wrapper, kp_source)
+    assert eye_delta.shape == (1, NUM_KP * 3) and eye_delta.device.type == 'cpu'
+    assert lip_delta.shape == (1, NUM_KP * 3) and lip_delta.device.type == 'cpu'
+    assert torch.isfinite(eye_delta).all() and torch.isfinite(lip_delta).all()
+
+
+def _forward(wrapper, image, inputs=None):
+    """ F and M on the image, W and G from its keypoints to a shifted copy of them
+    inputs: (f_s, x_s) to run W and G on instead, so that every network is compared on the same inputs
+    """
+    x = wrapper.prepare_source(image)
+    f_s = wrapper.extract_feature_3d(x)
+    x_s = wrapper.transform_keypoint(wrapper.get_kp_info(x))
+    f_s_w, x_s_w = (f_s, x_s) if inputs is None else inputs
+    x_d = x_s_w + 0.05
+    out = wrapper.warp_decode(f_s_w, x_s_w, x_d)['out']
+    prepared = wrapper.warp_decode(None, None, x_d, prepared_source=wrapper.prepare_warp_source(f_s_w, x_s_w))['out']
+    return f_s, x_s, out, prepared
+
+
+def _assert_close(actual, expected, rtol, mean_rtol=None):
+    scale = max(expected.abs().max().item(), 1.0)
+    diff = (actual - expected).abs()
+    assert diff.max().item() <= rtol * scale, f'max abs diff {diff.max().item():.3e} over {rtol * scale:.3e}'
+    if mean_rtol is not None:
+        assert diff.mean().item() <= mean_rtol * scale, f'mean abs diff {diff.mean().item():.3e} over {mean_rtol * scale:.3e}'
+
+
+@pytest.mark.parametrize('variant', ['frozen', 'bfloat16'])
+def test_forward_matches_fp32_reference(networks, variant, no_cuda):
+    image = np.random.RandomState(1).randint(0, 255, (256, 256, 3), dtype=np.uint8)
+    reference = _forward(make_wrapper(networks), image)
+    assert reference[2].shape == (1, 3, 512, 512)
+    _assert_close(reference[3], reference[2], 1e-5)  # the precomputed source path of W
+
+    if variant == 'frozen':
+        frozen = dict(networks)
+        for name in ('appearance_feature_extractor', 'warping_module', 'spade_generator'):
+            frozen[name] = freeze_for_inference(copy.deepcopy(networks[name]))
+        result, tolerance = _forward(make_wrapper(frozen), image, reference[:2]), (1e-3,)
+    else:
+        if not live_portrait_wrapper.cpu_supports_bf16():
+            pytest.skip('no native bf16 on this cpu')
+        result, tolerance = _forward(make_wrapper(networks, flag_use_half_precision=True, half_precision_dtype='bfloat16'), image, reference[:2]), (0.2, 0.03)  # 8 bits of mantissa, through random weights
+
+    for actual, expected in zip(result, reference):
+        assert actual.dtype == torch.float32 and actual.device.type == 'cpu'
+        _assert_close(actual, expected, *tolerance)
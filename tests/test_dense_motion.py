@@ -0,0 +1,73 @@
+# coding: utf-8
+
+"""
+the deformation of DenseMotionNetwork against the repeat-and-sum formulation it replaces
+"""
+
+import torch
+import torch.nn.functional as F
+
+from liveportrait.modules.dense_motion import DenseMotionNetwork
+
+NUM_KP = 21
+
+
+def make_network():
+    torch.manual_seed(0)
+    return DenseMotionNetwork(block_expansion=8, num_blocks=2, max_features=32, num_kp=NUM_KP, feature_channel=8,
+                              reshape_depth=4, compress=2).eval()
+
+
+def make_inputs(bs=2, c=2, d=4, h=16, w=16):
+    generator = torch.Generator().manual_seed(1)
+    feature = torch.randn(bs, c, d, h, w, generator=generator)
+    kp_source = torch.rand(bs, NUM_KP, 3, generator=generator) * 2 - 1
+    kp_driving = kp_source + torch.randn(bs, NUM_KP, 3, generator=generator) * 0.1
+    return feature, kp_driving, kp_source
+
+
+def reference_deformed_feature(feature, sparse_motions, num_kp):
+    # every motion samples its own copy of the feature
+    bs, _, d, h, w = feature.shape
+    feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, num_kp + 1, 1, 1, 1, 1, 1)
+    feature_repeat = feature_repeat.view(bs * (num_kp + 1), -1, d, h, w)
+    sparse_motions = sparse_motions.reshape((bs * (num_kp + 1), d, h, w, -1))
+    sparse_deformed = F.grid_sample(feature_repeat, sparse_motions, align_corners=False)
+    return sparse_deformed.view((bs, num_kp + 1, -1, d, h, w))
+
+
+def reference_deformation(sparse_motions, mask):
+    mask = mask.unsqueeze(2)
+    sparse_motions = sparse_motions.permute(0, 1, 5, 2, 3, 4)
+    return (sparse_motions * mask).sum(dim=1).permute(0, 2, 3, 4, 1)
+
+
+def test_deformed_feature_matches_reference():
+    network = make_network()
+    feature, kp_driving, kp_source = make_inputs()
+    sparse_motions = network.create_sparse_motions(feature, kp_driving, kp_source)
+    expected = reference_deformed_feature(feature, sparse_motions, NUM_KP)
+    actual = network.create_deformed_feature(feature, sparse_motions)
+    assert actual.shape == expected.shape == (2, NUM_KP + 1, 2, 4, 16, 16)
+    assert torch.allclose(actual, expected, atol=1e-6)
+
+
+def test_deformation_matches_reference():
+    network = make_network()
+    feature, kp_driving, kp_source = make_inputs()
+    sparse_motions = network.create_sparse_motions(feature, kp_driving, kp_source)
+    mask = F.softmax(torch.randn(2, NUM_KP + 1, 4, 16, 16, generator=torch.Generator().manual_seed(2)), dim=1)
+    expected = reference_deformation(sparse_motions, mask)
+    actual = network.create_deformation(sparse_motions, mask)
+    assert actual.shape == expected.shape == (2, 4, 16, 16, 3)
+    assert torch.allclose(actual, expected, atol=1e-6)
+
+
+def test_forward_deformation_matches_reference():
+    network = make_network()
+    feature, kp_driving, kp_source = make_inputs(c=8)
+    with torch.no_grad():
+        out = network(feature, kp_driving, kp_source)
+        compressed = F.relu(network.norm(network.compress(feature)))
+        sparse_motions = network.create_sparse_motions(compressed, kp_driving, kp_source)
+    assert torch.allclose(out['deformation'], reference_deformation(sparse_motions, out['mask']), atol=1e-6)
@@ -0,0 +1,84 @@
+# coding: utf-8
+
+"""
+PipelinedExecutor: ordering, error propagation and cleanup
+"""
+
+import threading
+
+import pytest
+
+from liveportrait.utils.executor import PipelinedExecutor
+
+
+class Items(object):
+    """ a generator of n items that records whether it was closed """
+
+    def __init__(self, n):
+        self.n = n
+        self.pulled = 0
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        return self.generate()
+
+    def generate(self):
+        try:
+            for i in range(self.n):
+                self.pulled += 1
+                yield i
+        finally:
+            self.closed.set()
+
+
+def _pipeline_threads(name):
+    return [thread for thread in threading.enumerate() if thread.name.startswith(name + '-')]
+
+
+@pytest.mark.parametrize('queue_depth', [0, 2])
+def test_results_in_order(queue_depth):
+    executor = PipelinedExecutor([('double', lambda x: x * 2), ('inc', lambda x: x + 1)], queue_depth=queue_depth, name='order')
+    assert list(executor.run(range(20))) == [x * 2 + 1 for x in range(20)]
+    assert executor.stats['double'].items == 20 and executor.stats['inc'].items == 20
+    assert not _pipeline_threads('order')
+
+
+@pytest.mark.parametrize('queue_depth', [0, 2])
+def test_stage_error_propagates_and_cleans_up(queue_depth):
+    def fail_at_3(x):
+        if x == 3:
+            raise ValueError('stage failed at 3')
+        return x
+
+    items = Items(100)
+    generator = iter(items)
+    executor = PipelinedExecutor([('first', lambda x: x), ('failing', fail_at_3), ('last', lambda x: x)], queue_depth=queue_depth, name='failing')
+    results = []
+    with pytest.raises(ValueError, match='stage failed at 3'):
+        for result in executor.run(generator):
+            results.append(result)
+
+    assert results == [0, 1, 2]
+    assert items.closed.is_set()  # the items generator is closed, not left to the garbage collector
+    assert items.pulled < 100
+    assert not _pipeline_threads('failing')  # every thread joined
+
+
+def test_consumer_stop_closes_items():
+    items = Items(100)
+    executor = PipelinedExecutor([('identity', lambda x: x)], queue_depth=2, name='stopped')
+    run = executor.run(iter(items))
+    assert next(run) == 0
+    run.close()
+    assert items.closed.is_set()
+    assert not _pipeline_threads('stopped')
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_dead_stage_thread_does_not_hang(monkeypatch):
+    executor = PipelinedExecutor([('identity', lambda x: x)], queue_depth=2, name='dead')
+    # a stage thread that dies outside of the error handling, without forwarding anything
+    monkeypatch.setattr(executor, '_call', lambda name, fn, item: (_ for _ in ()).throw(SystemExit()))
+    with pytest.raises(RuntimeError, match='dead-identity exited without finishing'):
+        list(executor.run(range(5)))
+    assert not _pipeline_threads('dead')
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+"""
+PatchFrames: full frames rebuilt from the patches, with sources of different sizes; TorchPasteBack moved between devices
+"""
+
+import numpy as np
+import pytest
+import torch
+
+from liveportrait.utils.paste_back import PatchFrames, TorchPasteBack
+
+
+def make_patch_frames(shapes, n_frames=3, seed=0):
+    """ PatchFrames of one source per (h, w), and the full uint8 frames they hold """
+    rng = np.random.RandomState(seed)
+    patch_frames = PatchFrames(len(shapes), n_frames)
+    expected = []
+    for source_index, (h, w) in enumerate(shapes):
+        background = rng.randint(0, 255, (h, w, 3), dtype=np.uint8)
+        roi = (slice(h // 4, h // 2), slice(w // 3, w // 3 + 40))
+        patches = rng.randint(0, 255, (n_frames, h // 2 - h // 4, 40, 3), dtype=np.uint8)
+        patch_frames.set_source(source_index, background, roi)
+        patch_frames.write_batch(source_index, 0, patches)
+        for patch in patches:
+            frame = background.copy()
+            frame[roi] = patch
+            expected.append(torch.from_numpy(frame).float() / 255)
+    return patch_frames, expected
+
+
+def test_composite_one_shape():
+    patch_frames, expected = make_patch_frames([(260, 200), (260, 200)])
+    assert patch_frames.frame_shape == (260, 200, 3)
+    assert torch.equal(patch_frames.composite(), torch.stack(expected))
+    assert torch.equal(patch_frames.composite(2, 5), torch.stack(expected[2:5]))
+    chunks = [(start, frames.clone()) for start, frames in patch_frames.iter_chunks(4)]  # the buffer is reused
+    assert [start for start, _ in chunks] == [0, 4]
+    assert torch.equal(torch.cat([frames for _, frames in chunks]), torch.stack(expected))
+
+
+def test_mixed_sizes():
+    patch_frames, expected = make_patch_frames([(260, 200), (320, 240), (320, 240)])
+
+    # a range within one shape composites as usual, a range across shapes is a clear error
+    assert torch.equal(patch_frames.composite(3, 9), torch.stack(expected[3:9]))
+    with pytest.raises(ValueError, match='different shapes'):
+        patch_frames.composite()
+    with pytest.raises(ValueError, match='different frame shapes'):
+        patch_frames.frame_shape
+
+    groups = patch_frames.composite_groups()
+    assert [(start, tuple(frames.shape)) for start, frames in groups] == [(0, (3, 260, 200, 3)), (3, (6, 320, 240, 3))]
+    assert torch.equal(torch.cat([frames.flatten(1) for _, frames in groups[1:]]), torch.stack(expected[3:]).flatten(1))
+    assert torch.equal(groups[0][1], torch.stack(expected[:3]))
+
+    # chunks stop where the shape changes, every frame comes out once, in order
+    frames = []
+    for start, chunk in patch_frames.iter_chunks(4):
+        assert len({tuple(f.shape) for f in chunk}) == 1
+        frames += [(start + k, f.clone()) for k, f in enumerate(chunk)]
+    assert [index for index, _ in frames] == list(range(9))
+    assert all(torch.equal(f, expected[index]) for index, f in frames)
+
+
+def test_torch_paste_back_to():
+    img_rgb = np.random.RandomState(0).randint(0, 255, (60, 50, 3), dtype=np.uint8)
+    M_c2o = np.array([[0.1, 0., 10.], [0., 0.1, 12.], [0., 0., 1.]], dtype=np.float32)
+    paste_back = TorchPasteBack(img_rgb, M_c2o, np.full((256, 256), 255, dtype=np.uint8), 'cpu')
+    assert paste_back.to('cpu') is paste_back
+    moved = paste_back.to('meta')  # the cached source is kept on the cpu and moved to the device to render
+    assert moved is not paste_back and paste_back.grid.device.type == 'cpu'
+    assert {moved.grid.device.type, moved.mask.device.type, moved.img.device.type} == {'meta'}
+    assert moved.roi == paste_back.roi
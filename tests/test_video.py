@@ -0,0 +1,56 @@
+# coding: utf-8
+
+"""
+DrivingVideo: clips whose header does not give the frame count
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from liveportrait.utils import video
+from liveportrait.utils.video import DrivingVideo
+
+
+def write_clip(path, n_frames, size=(64, 48)):
+    """ an mjpg avi of n_frames of distinct flat colors """
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'MJPG'), 25, size)
+    for i in range(n_frames):
+        writer.write(np.full((size[1], size[0], 3), 20 * i, dtype=np.uint8))
+    writer.release()
+    return str(path)
+
+
+@pytest.fixture
+def no_frame_count(monkeypatch):
+    """ cv2.VideoCapture reporting a frame count of 0, as for some webm and gif files """
+    capture = cv2.VideoCapture
+
+    class VideoCapture(object):
+        def __init__(self, *args):
+            self.cap = capture(*args)
+
+        def get(self, prop):
+            return 0. if prop == cv2.CAP_PROP_FRAME_COUNT else self.cap.get(prop)
+
+        def __getattr__(self, name):
+            return getattr(self.cap, name)
+
+    monkeypatch.setattr(video.cv2, 'VideoCapture', VideoCapture)
+
+
+def test_frames_counted_without_frame_count(tmp_path, no_frame_count):
+    path = write_clip(tmp_path / 'clip.avi', 7)
+    driving = DrivingVideo(path, prefetch=0)
+    assert len(driving) == 7
+    chunks = list(driving.iter_chunks(4))
+    assert [len(chunk) for chunk in chunks] == [4, 3]
+    assert np.abs(chunks[1][-1].astype(int) - 120).max() <= 3
+
+    assert len(DrivingVideo(path, start_frame=2, frame_count=3, prefetch=0)) == 3
+
+
+def test_empty_range_raises(tmp_path, no_frame_count):
+    path = write_clip(tmp_path / 'clip.avi', 5)
+    with pytest.raises(ValueError, match='clip.avi'):
+        DrivingVideo(path, start_frame=5)